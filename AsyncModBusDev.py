@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# asyncio variant of ModBusDev for Modbus TCP devices.
+#
+# Register map, batch planning, request splitting, limit probing, write
+# encoding / verification and decoding are shared with ModBusDev, only the
+# transport is awaited, so many inverters can be polled from one loop:
+#
+#   devs = [growatt.AsyncSPH(host=h) for h in hosts]
+#   results = await asyncio.gather(*(d.read_list(keys) for d in devs))
+#
+# pymodbus 2.5.3 ships an asyncio client, but it does not run on python >= 3.11
+# (asyncio.coroutine was removed), so a small TCP transport is used here.
+
+import time
+import asyncio
+import struct
+import logging
+
+from pymodbus.factory import ClientDecoder
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.register_read_message import ReadInputRegistersRequest
+from pymodbus.register_read_message import ReadHoldingRegistersRequest
+from pymodbus.register_read_message import ReadInputRegistersResponse
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from pymodbus.register_write_message import WriteMultipleRegistersRequest
+from pymodbus.payload import BinaryPayloadDecoder
+
+from ModBusDev import ModBusDev, RequestRejected, Sample, next_tick, connectionType, registerType, TIMEOUT, RETRIES, UNIT
+from capture import CaptureWriter
+
+
+class AsyncModbusTcpClient:
+	"""minimal Modbus TCP client, one transaction in flight per connection"""
+
+	def __init__(self, host, port=502, timeout=TIMEOUT):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+
+		self.reader = None
+		self.writer = None
+		self.decoder = ClientDecoder()
+		self.lock = asyncio.Lock()
+		self.tid = 0
+
+	async def connect(self):
+		try:
+			self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+		except (OSError, asyncio.TimeoutError) as e:
+			logging.debug(f"connecting {self.host}:{self.port} failed: {e}")
+			self.reader = self.writer = None
+			return False
+		return True
+
+	def close(self):
+		if self.writer:
+			self.writer.close()
+		self.reader = self.writer = None
+
+	def is_socket_open(self):
+		return self.writer is not None and not self.writer.is_closing()
+
+	async def execute(self, request):
+		async with self.lock:
+			if not self.is_socket_open():
+				return ModbusIOException("not connected")
+
+			self.tid = (self.tid + 1) & 0xffff
+			pdu = struct.pack(">B", request.function_code) + request.encode()
+			self.writer.write(struct.pack(">HHHB", self.tid, 0, len(pdu) + 1, request.unit_id) + pdu)
+
+			try:
+				await self.writer.drain()
+				while True:
+					tid, pid, length, unit = struct.unpack(">HHHB", await asyncio.wait_for(self.reader.readexactly(7), self.timeout))
+					pdu = await asyncio.wait_for(self.reader.readexactly(length - 1), self.timeout)
+					if tid == self.tid:
+						break
+			except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+				self.close()
+				return ModbusIOException(f"{e!r}")
+
+			return self.decoder.decode(pdu)
+
+	async def read_input_registers(self, address, count=1, unit=UNIT):
+		return await self.execute(ReadInputRegistersRequest(address, count, unit=unit))
+
+	async def read_holding_registers(self, address, count=1, unit=UNIT):
+		return await self.execute(ReadHoldingRegistersRequest(address, count, unit=unit))
+
+	async def write_registers(self, address, values, unit=UNIT):
+		return await self.execute(WriteMultipleRegistersRequest(address, values, unit=unit))
+
+
+class AsyncModBusDev(ModBusDev):
+
+	def __init__(self, **kwargs):
+		parent = kwargs.get("parent")
+
+		if ( cachefile := kwargs.get("cachefile", parent.cachefile if parent else None) ):
+		    self.cachefile = cachefile
+
+		if parent:
+		    self.client = parent.client
+		    self.host = parent.host
+		    self.port = parent.port
+		    self.timeout = parent.timeout
+		    self.retries = parent.retries
+		    self.unit = kwargs.get("unit") or parent.unit
+		    self.recorder = parent.recorder
+		else:
+		    self.host = kwargs.get("host")
+		    self.port = kwargs.get("port", 502)
+		    self.timeout = kwargs.get("timeout", TIMEOUT)
+		    self.retries = kwargs.get("retries", RETRIES)
+		    self.unit = kwargs.get("unit", UNIT)
+
+		    self.client = AsyncModbusTcpClient(self.host, self.port, self.timeout)
+
+		    capture = kwargs.get("capture")
+		    self.recorder = CaptureWriter(capture) if capture else None
+
+		self.mode = connectionType.TCP
+		self._init_state()
+
+	async def _read_raw(self, address, length, rtype):
+		if rtype == registerType.INPUT:
+			request = self.client.read_input_registers
+			response = ReadInputRegistersResponse
+		elif rtype == registerType.HOLDING:
+			request = self.client.read_holding_registers
+			response = ReadHoldingRegistersResponse
+		else:
+			raise NotImplementedError(rtype)
+
+		attempts = self._breaker_attempts()
+		for i in range(attempts):
+		    if i:
+		        self.metrics.retry()
+		        await asyncio.sleep(self._backoff(i))
+
+		    if not self.connected():
+		        self.metrics.reconnect()
+		        if not await self.connect():
+		            continue
+
+		    self._apply_timeout(self._rtt_timeout(length, i))
+
+		    start = time.monotonic()
+		    result = await request(address, length, unit=self.unit)
+		    seconds = time.monotonic() - start
+
+		    outcome = self._check_response(result, response, address, length, rtype, seconds)
+		    if outcome != "ok":
+		        self._check_rejected(result, outcome, address, length)
+		        continue
+
+		    if self.recorder:
+		        self.recorder.record(self.unit, rtype, address, result.registers)
+
+		    self._rtt_update(length, seconds)
+		    self._breaker_result(True)
+		    return result.registers
+
+		if attempts:
+		    self._breaker_result(False)
+		return None
+
+	def _apply_timeout(self, timeout):
+		self.client.timeout = timeout
+
+	async def _read_compiled(self, plan, rtype):
+		if plan is None: # if empty request
+			return {}
+
+		started = time.monotonic()
+		split = self._splits.get((rtype, plan[0], plan[1], plan[3]))
+		if split is None:
+			try:
+				registers = await self._read_raw(plan[0], plan[1], rtype)
+			except RequestRejected as e:
+				split = self._split(plan, rtype, e)
+
+		if split is not None:
+			results = {}
+			for p in split:
+				results.update(await self._read_compiled(p, rtype))
+			return results
+
+		return self._block_results(plan, rtype, registers, started)
+
+	async def _read_all(self, values, rtype):
+		return await self._read_compiled(self._compile(values), rtype)
+
+	async def probe_limits(self):
+		for rtype in registerType:
+			steps = self._probe_steps(rtype)
+			try:
+				address, length = next(steps)
+				while True:
+					try:
+						answer = await self._read_raw(address, length, rtype)
+					except RequestRejected as e:
+						answer = e
+					address, length = steps.send(answer)
+			except StopIteration:
+				pass
+
+		return self._probe_done()
+
+	async def _read(self, value):
+		address, length, rtype, dtype, vtype, label, fmt, sf = value
+
+		registers = await self._read_raw(address, length, rtype)
+		rawdata = BinaryPayloadDecoder.fromRegisters(registers, byteorder=self.byteorder, wordorder=self.wordorder) if registers else None
+
+		return self._decode_value(rawdata, (length * self.bytesperregister), dtype, vtype)
+
+	async def _write_holding_register(self, address, value):
+		if not self.connected():
+			await self.connect()
+		self._apply_timeout(self.timeout)
+		result = await self.client.write_registers(address, value, unit=self.unit)
+		self._cache_invalidate(address, len(value)) # after the ack, see _cache_store()
+		return result
+
+	async def _write(self, value, data):
+		address, length, rtype, dtype, vtype, label, fmt, sf = value
+
+		if rtype == registerType.HOLDING:
+		    return await self._write_holding_register(address, self._encode_value(data, dtype))
+		else:
+		    raise NotImplementedError(rtype)
+
+	async def connect(self):
+		return await self.client.connect()
+
+	async def load_cache(self):
+		if not self.cachefile or not self.serialkey:
+			return False
+
+		return self._restore_cache((await self.read_list([self.serialkey])).get(self.serialkey))
+
+	async def read(self, key, scaling=True):
+		if key not in self.registers:
+		    raise KeyError(key)
+
+		if scaling:
+		    return await self._read(self.registers[key]) * self.get_scaling(key)
+		else:
+		    return await self._read(self.registers[key])
+
+	async def write(self, key, data):
+		if key not in self.registers:
+		    raise KeyError(key)
+
+		return await self._write(self.registers[key], data / self.get_scaling(key))
+
+	async def write_many(self, values, verify=False):
+		writes = self._encode_many(values)
+		ok = {}
+
+		for address, registers, keys in writes:
+			ok.update(dict.fromkeys(keys, self._write_ok(await self._write_holding_register(address, registers))))
+
+		if verify:
+			for plan in self._plan(frozenset(ok), registerType.HOLDING):
+				self._verify_block(plan, await self._read_raw(plan[0], plan[1], registerType.HOLDING), writes, values, ok)
+
+		return ok
+
+	async def _read_plans(self, plans):
+		results = {}
+		batches = []
+		start = time.monotonic()
+
+		for plan, rtype in plans:
+			t = time.monotonic()
+			results.update(await self._read_compiled(plan, rtype))
+			batches.append((rtype.name, plan[0], plan[1], time.monotonic() - t))
+
+		self.metrics.cycle_done(time.monotonic() - start, batches)
+		return results
+
+	async def read_all(self, rtype=registerType.INPUT):
+		results = await self._read_plans((plan, rtype) for plan in self._plan(None, rtype))
+
+		return self._clean_data(results)
+
+	async def read_list(self, items, cached=True):
+		results, plans = self._list_plans(items, cached)
+		results.update(await self._read_plans(plans))
+
+		return self._clean_data(results)
+
+	async def stream(self, keys, interval, count=None):
+		keys = frozenset(keys)
+		start = time.monotonic()
+		tick = skipped = n = 0
+
+		while count is None or n < count:
+			wait = start + tick * interval - time.monotonic()
+			if wait > 0:
+				await asyncio.sleep(wait)
+
+			t = time.time()
+			t0 = time.monotonic()
+			values = await self.read_list(keys)
+
+			yield Sample(t, values, time.monotonic() - t0, skipped)
+			n += 1
+
+			tick, skipped = next_tick(start, interval, tick)
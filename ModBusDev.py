@@ -1,16 +1,31 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import os
 import enum
+import json
+import math
+import bisect
+import random
+import struct
 import time
 import logging
+import collections
+import collections.abc
 
 from pymodbus.constants import Endian
 from pymodbus.client.sync import ModbusSerialClient as ModbusSerialClient
+from pymodbus.client.sync import ModbusTcpClient as ModbusTcpClient
 from pymodbus.payload import BinaryPayloadBuilder
 from pymodbus.payload import BinaryPayloadDecoder
 from pymodbus.register_read_message import ReadInputRegistersResponse
 from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+
+from metrics import Metrics
+from arbiter import BusArbiter, CONTROL, DEMAND, POLL, NAMES as PRIORITIES
+from capture import CaptureWriter, ReplayClient
 
 
 class connectionType(enum.Enum):
@@ -40,6 +55,105 @@ class registerDataType(enum.Enum):
 	HEX = 14
 
 
+class Register(collections.namedtuple("Register", "address length rtype dtype vtype label fmt sf")):
+	"""one register map entry, still unpacks like the plain 8-tuple"""
+	__slots__ = ()
+
+
+# one sample of ModBusDev.stream(): wall clock time of the read, values, read
+# duration in s, ticks skipped before this one (read overrun or slow consumer)
+Sample = collections.namedtuple("Sample", "time values duration skipped")
+
+
+def next_tick(start, interval, tick):
+	"""(next tick, skipped ticks) of a stream started at monotonic `start`: ticks
+	that are already over are skipped, not read in a burst"""
+	elapsed = math.floor((time.monotonic() - start) / interval)
+	nxt = max(tick + 1, elapsed)
+	return nxt, nxt - tick - 1
+
+
+class RegisterMap(collections.abc.Mapping):
+	"""immutable register map {key: Register}, built once per device class
+
+	Keeps the entries of every registerType sorted by address as (key, *register)
+	for the batch planner and an interval index for address -> key lookups.
+	Overlapping registers are rejected.
+	"""
+	__slots__ = ("_registers", "_sorted", "_starts")
+
+	def __init__(self, registers=None):
+		self._registers = {k: Register(*v) for k, v in (registers or {}).items()}
+		self._sorted = {}
+		self._starts = {}
+
+		for rtype in registerType:
+			entries = sorted(((k, *r) for k, r in self._registers.items() if r.rtype == rtype), key=lambda e: e[1])
+
+			end = None
+			for k, address, length, *rest in entries:
+				if length < 1:
+					raise ValueError(f"{k}: length {length}")
+				if end is not None and address < end[0]:
+					raise ValueError(f"{k} at {address} overlaps {end[1]}")
+				end = (address + length, k)
+
+			self._sorted[rtype] = tuple(entries)
+			self._starts[rtype] = [e[1] for e in entries]
+
+	def __getitem__(self, key):
+		return self._registers[key]
+
+	def __contains__(self, key):
+		return key in self._registers
+
+	def __iter__(self):
+		return iter(self._registers)
+
+	def __len__(self):
+		return len(self._registers)
+
+	def get(self, key, default=None):
+		return self._registers.get(key, default)
+
+	def sorted(self, rtype):
+		"""(key, address, length, ...) of all registers of rtype, sorted by address"""
+		return self._sorted[rtype]
+
+	def lookup(self, rtype, address):
+		"""key of the register containing address or None"""
+		i = bisect.bisect_right(self._starts[rtype], address) - 1
+		if i >= 0:
+			e = self._sorted[rtype][i]
+			if address < e[1] + e[2]:
+				return e[0]
+		return None
+
+	def overlapping(self, rtype, address, length):
+		"""keys of the registers overlapping address:length"""
+		entries = self._sorted[rtype]
+		i = max(0, bisect.bisect_right(self._starts[rtype], address) - 1)
+
+		keys = []
+		for e in entries[i:]:
+			if e[1] >= address + length:
+				break
+			if address < e[1] + e[2]:
+				keys.append(e[0])
+		return keys
+
+
+class RequestRejected(Exception):
+	"""the device answered a read, but not with the requested registers
+
+	`received`: number of registers of a short answer, `code`: modbus exception code
+	"""
+	def __init__(self, address, length, received=None, code=None):
+		super().__init__(f"{address}:{length} rejected (received {received}, exception {code})")
+		self.received = received
+		self.code = code
+
+
 RETRIES = 3
 TIMEOUT = 1
 UNIT = 1
@@ -47,7 +161,7 @@ UNIT = 1
 
 class ModBusDev:
 	model = "Generic"
-	registers = {}
+	registers = RegisterMap()
 
 	stopbits = 1
 	parity = "N"
@@ -57,16 +171,57 @@ class ModBusDev:
 	byteorder = Endian.Big
 	bytesperregister = 2
 	charset = "ascii"
-	batchlimit = 75
+	batchlimit = 75			# registers per request until the device limit is known, see probe_limits()
+	maxrequest = 125			# modbus limit for function 3 / 4
+	probeshorts = 3			# short answers of different length before probe_limits() gives up
+	writelimit = 123			# registers per write request (function 16)
+
+	# bus cost model used by the batch planner
+	turnaround = 0.03		# s, device response delay per request
+	frameoverhead = 13		# bytes, RTU read request (8) + response header/crc (5)
+	framegap = 7			# chars, 2x 3.5 char silent interval
+	maxplans = 64			# compiled plans kept per device (least recently used are dropped)
+
+	# poll interval in s per register key, see scheduler.py
+	pollinterval = 5
+	pollintervals = {}
+
+	# holding register cache: ttl in s per key (math.inf: until written),
+	# keys in cachepersist are stored in `cachefile`, keyed by the serial number
+	cachettl = {}
+	cachepersist = ()
+	serialkey = None
+	cachefile = None
+
+	# holding registers that servers (pv2mqtt, busd.py, gateway.py) let their clients write,
+	# encoders: key: callable turning a written value into what the register type takes
+	writable = ()
+	encoders = {}
+
+	# learned request timeout between mintimeout and self.timeout (doubled per retry),
+	# retry backoff, circuit breaker: after breakerthreshold failed reads only probe every
+	# probeinterval s (doubling up to probemax) until the device answers again
+	mintimeout = 0.1
+	timeoutmargin = 0.1
+	backoff = 0.1
+	backoffmax = 2
+	breakerthreshold = 3
+	probeinterval = 5
+	probemax = 60
 
 	def __init__(self, **kwargs):
 		parent = kwargs.get("parent")
 
+		if ( cachefile := kwargs.get("cachefile", parent.cachefile if parent else None) ):
+		    self.cachefile = cachefile
+
 		if parent:
 		    self.client = parent.client
+		    self.buslock = parent.buslock
 		    self.mode = parent.mode
 		    self.timeout = parent.timeout
 		    self.retries = parent.retries
+		    self.recorder = parent.recorder
 
 		    unit = kwargs.get("unit")
 
@@ -89,6 +244,7 @@ class ModBusDev:
 		    self.timeout = kwargs.get("timeout", TIMEOUT)
 		    self.retries = kwargs.get("retries", RETRIES)
 		    self.unit = kwargs.get("unit", UNIT)
+		    self.buslock = BusArbiter() # shared by all units on this client, see arbiter.py
 
 		    device = kwargs.get("device")
 
@@ -130,8 +286,36 @@ class ModBusDev:
 		            timeout=self.timeout
 		        )
 
+		    # record every answered read / answer reads from a capture, see capture.py
+		    capture = kwargs.get("capture")
+		    self.recorder = CaptureWriter(capture) if capture else None
+
+		    if ( replay := kwargs.get("replay") ):
+		        self.client = ReplayClient(replay, speed=kwargs.get("speed"), timeout=self.timeout)
+
+		    # any client with the pymodbus sync interface, e.g. a test double
+		    if ( client := kwargs.get("client") ):
+		        self.client = client
+
+		self._init_state()
 		self.connect()
 
+	def _init_state(self):
+		self._plans = collections.OrderedDict()	# (frozenset of keys, rtype): plan, LRU
+		self._splits = {}			# (rtype, address, length, keys): plans replacing a rejected request
+		self._cache = {}
+		self._written = {}			# key: monotonic time of the last write ack
+		self.limits = {}			# registerType: learned registers per request
+		self._probed = set()		# registerTypes with an exact limit
+		self._shorts = {}			# registerType: length of the last short answer
+		self.metrics = Metrics({"model": self.model, "unit": self.unit})
+
+		self._srtt = None			# s, smoothed response time beyond the cost model
+		self._rttvar = 0.0
+		self._failures = 0
+		self._probe_at = 0.0
+		self._probe_delay = self.probeinterval
+
 	def _clean_data(self, results):
 		return results
 
@@ -143,43 +327,182 @@ class ModBusDev:
 		else:
 		    return f"<{self.__class__.__module__}.{self.__class__.__name__} object at {hex(id(self))}>"
 
-	def _read_input_registers(self, address, length):
-		for i in range(self.retries):
+	def _read_raw(self, address, length, rtype):
+		"""read `length` registers, returns the list of register values or None"""
+		if rtype == registerType.INPUT:
+			request = self.client.read_input_registers
+			response = ReadInputRegistersResponse
+		elif rtype == registerType.HOLDING:
+			request = self.client.read_holding_registers
+			response = ReadHoldingRegistersResponse
+		else:
+			raise NotImplementedError(rtype)
+
+		attempts = self._breaker_attempts()
+		for i in range(attempts):
+		    if i:
+		        self.metrics.retry()
+		        time.sleep(self._backoff(i))
+
 		    if not self.connected():
+		        self.metrics.reconnect()
 		        self.connect()
-		        time.sleep(0.1)
+		        if not self.connected():
+		            continue
+
+		    with self.buslock as wait:
+		        self._apply_timeout(self._rtt_timeout(length, i)) # not while another thread reads
+		        start = time.monotonic()
+		        result = request(address=address, count=length, unit=self.unit)
+		        seconds = time.monotonic() - start
+		    self.metrics.bus_wait(PRIORITIES.get(self.buslock.current(), "other"), wait)
+
+		    outcome = self._check_response(result, response, address, length, rtype, seconds)
+		    if outcome != "ok":
+		        self._check_rejected(result, outcome, address, length)
 		        continue
 
-		    result = self.client.read_input_registers(address=address, count=length, slave=self.unit)
+		    if self.recorder:
+		        self.recorder.record(self.unit, rtype, address, result.registers)
 
-		    if not isinstance(result, ReadInputRegistersResponse):
-		        continue
-		    if len(result.registers) != length:
-		        continue
+		    self._rtt_update(length, seconds)
+		    self._breaker_result(True)
+		    return result.registers
 
-		    return BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=self.byteorder, wordorder=self.wordorder)
+		if attempts:
+		    self._breaker_result(False)
 		return None
 
-	def _read_holding_registers(self, address, length):
-		for i in range(self.retries):
-		    if not self.connected():
-		        self.connect()
-		        time.sleep(0.1)
-		        continue
+	# ----------------------------------------------------------------------------------	
+	def _rtt_timeout(self, length, attempt=0):
+		"""timeout for a request of `length` registers, learned from answered requests
 
-		    result = self.client.read_holding_registers(address=address, count=length, slave=self.unit)
+		Long frames get `timeoutmargin` of their cost on top (the response time of
+		the adapter grows with the frame), every retry doubles the timeout.
+		"""
+		if self._srtt is None:
+			return self.timeout
 
-		    if not isinstance(result, ReadHoldingRegistersResponse):
-		        continue
-		    if len(result.registers) != length:
-		        logging.warning(f"{address}:{length} requested, but only {len(result.registers)} recieved")
-		        continue
+		cost = self._request_cost(length)
+		timeout = cost * (1 + self.timeoutmargin) + self._srtt + 4 * self._rttvar
+		return min(self.timeout, max(self.mintimeout, timeout) * 2 ** attempt)
 
-		    return BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=self.byteorder, wordorder=self.wordorder)
-		return None
+	def _rtt_update(self, length, seconds):
+		excess = seconds - self._request_cost(length)
+
+		if self._srtt is None:
+			self._srtt = excess
+			self._rttvar = abs(excess) / 2
+		else:
+			self._rttvar += (abs(self._srtt - excess) - self._rttvar) / 4
+			self._srtt += (excess - self._srtt) / 8
+
+	def _apply_timeout(self, timeout):
+		# the client may be shared with other units (parent=), so compare with its current timeout
+		applied = self.client.timeout
+		if applied and abs(timeout - applied) < 0.1 * applied:
+			return
+
+		self.client.timeout = timeout
+
+		sock = getattr(self.client, "socket", None)
+		if sock is None:
+			return
+		if self.mode is connectionType.RTU:
+			sock.timeout = timeout
+		else:
+			sock.settimeout(timeout)
+
+	def _backoff(self, attempt):
+		"""delay before retry `attempt`, exponential with jitter"""
+		return min(self.backoffmax, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+
+	def _breaker_attempts(self):
+		"""attempts allowed now: all retries, one probe or none while the circuit is open"""
+		if self._failures < self.breakerthreshold:
+			return self.retries
+		if time.monotonic() >= self._probe_at:
+			return 1
+		return 0
+
+	def _breaker_result(self, ok):
+		if ok:
+			if self._failures >= self.breakerthreshold:
+				logging.info(f"{self.model} unit {self.unit} answers again")
+			self._failures = 0
+			self._probe_delay = self.probeinterval
+			return
+
+		self._failures += 1
+		if self._failures >= self.breakerthreshold:
+			if self._failures == self.breakerthreshold:
+				logging.warning(f"{self.model} unit {self.unit} not answering, probing every {self.probeinterval}-{self.probemax}s")
+			self._probe_at = time.monotonic() + self._probe_delay * random.uniform(0.8, 1.2)
+			self._probe_delay = min(self.probemax, self._probe_delay * 2)
+
+	def offline(self):
+		"""True while the circuit breaker is open"""
+		return self._failures >= self.breakerthreshold
+
+	def probe_wait(self):
+		"""seconds until the next probe of an offline device (0 if online)"""
+		if not self.offline():
+			return 0
+		return max(0.0, self._probe_at - time.monotonic())
+
+	def _check_response(self, result, response, address, length, rtype, seconds):
+		"""classify a read response into self.metrics, returns the outcome ("ok": usable)"""
+		registers = 0
+		if isinstance(result, ModbusIOException):
+			outcome = "timeout"
+		elif not isinstance(result, response):
+			outcome = "invalid"
+		elif len(result.registers) != length:
+			logging.warning(f"{address}:{length} requested, but only {len(result.registers)} recieved")
+			outcome = "short"
+			registers = len(result.registers)
+		else:
+			outcome = "ok"
+			registers = length
+
+		self.metrics.request(rtype.name, seconds, outcome, registers, self.frameoverhead)
+		return outcome
+
+	def _check_rejected(self, result, outcome, address, length):
+		"""raise RequestRejected if retrying the same request is pointless"""
+		if outcome == "short":
+			received, code = len(result.registers), None
+		elif isinstance(result, ExceptionResponse) and result.exception_code in (2, 3): # illegal address / value
+			received, code = None, result.exception_code
+		else:
+			return
+
+		self._breaker_result(True) # the device is there
+		raise RequestRejected(address, length, received, code)
+
+	def _read_input_registers(self, address, length):
+		registers = self._read_raw(address, length, registerType.INPUT)
+		if registers is None:
+			return None
+		return BinaryPayloadDecoder.fromRegisters(registers, byteorder=self.byteorder, wordorder=self.wordorder)
+
+	def _read_holding_registers(self, address, length):
+		registers = self._read_raw(address, length, registerType.HOLDING)
+		if registers is None:
+			return None
+		return BinaryPayloadDecoder.fromRegisters(registers, byteorder=self.byteorder, wordorder=self.wordorder)
 
 	def _write_holding_register(self, address, value):
-		return self.client.write_registers(address=address, values=value, slave=self.unit)
+		"""write with CONTROL priority, the command to ack latency goes to self.metrics"""
+		start = time.monotonic()
+		with self.buslock.priority(CONTROL), self.buslock as wait:
+			self._apply_timeout(self.timeout) # not the learned read timeout, a late ack would answer the next read
+			result = self.client.write_registers(address=address, values=value, unit=self.unit)
+		self._cache_invalidate(address, len(value)) # after the ack, see _cache_store()
+
+		self.metrics.bus_wait(PRIORITIES[CONTROL], wait)
+		self.metrics.command(time.monotonic() - start, self._write_ok(result))
+		return result
 
 	def _encode_value(self, data, dtype):
 		builder = BinaryPayloadBuilder(byteorder=self.byteorder, wordorder=self.wordorder)
@@ -188,13 +511,16 @@ class ModBusDev:
 		    if dtype == registerDataType.FLOAT32:
 		        builder.add_32bit_float(data)
 		    elif dtype == registerDataType.INT32:
-		        builder.add_32bit_int(data)
+		        builder.add_32bit_int(round(data)) # scaled values: 47.3 / 0.1 = 472.99...
 		    elif dtype == registerDataType.UINT32:
-		        builder.add_32bit_uint(data)
+		        builder.add_32bit_uint(round(data))
 		    elif dtype == registerDataType.INT16:
-		        builder.add_16bit_int(int(data))
+		        builder.add_16bit_int(round(data))
 		    elif dtype == registerDataType.UINT16:
-		        builder.add_16bit_uint(int(data))
+		        builder.add_16bit_uint(round(data))
+		    elif dtype == registerDataType.RAW:
+		        for r in data:
+		            builder.add_16bit_uint(int(r))
 		    else:
 		        raise NotImplementedError(dtype)
 		except NotImplementedError:
@@ -250,57 +576,256 @@ class ModBusDev:
 		except NotImplementedError:
 			raise
 
-	def _read_all(self, values, rtype):
-		results = {}
-
-		if values == []: # if empty request
-			return results
+	def _compile_value(self, dtype, vtype, nbytes):
+		"""struct format and post processing callable for one value"""
+		bo = self.byteorder
+		wo = self.wordorder
+
+		if dtype in [registerDataType.INT16, registerDataType.UINT16] and nbytes != 2:
+			raise ValueError(f"incorrect data length {nbytes}B for type: {dtype}")
+		elif dtype in [registerDataType.FLOAT32, registerDataType.INT32, registerDataType.UINT32] and nbytes != 4:
+			raise ValueError(f"incorrect data length {nbytes}B for type: {dtype}")
+
+		if dtype == registerDataType.UINT16:
+			return "H", vtype
+		elif dtype == registerDataType.INT16:
+			return "h", vtype
+		elif dtype in [registerDataType.UINT32, registerDataType.INT32, registerDataType.FLOAT32]:
+			f = {registerDataType.UINT32: "I", registerDataType.INT32: "i", registerDataType.FLOAT32: "f"}[dtype]
+			if bo == wo:
+				return f, vtype
+
+			# byte and word order differ: reorder the words like BinaryPayloadDecoder
+			def post(raw):
+				words = struct.unpack(">HH", raw)
+				if wo == Endian.Little:
+					words = words[::-1]
+				return vtype(struct.unpack(f">{f}", struct.pack(f"{bo}HH", *words))[0])
+			return "4s", post
+		elif dtype == registerDataType.STRING:
+			return f"{nbytes}s", lambda raw: vtype(raw.decode(self.charset))
+		elif dtype == registerDataType.HEX:
+			return f"{nbytes}s", lambda raw: vtype([hex(x) for x in struct.unpack(f"{nbytes}b", raw)])
+		elif dtype == registerDataType.RAW:
+			return f"{nbytes}s", lambda raw: vtype(BinaryPayloadDecoder(raw, byteorder=bo, wordorder=wo))
+		else:
+			raise NotImplementedError(dtype)
+
+	@staticmethod
+	def _compile_enum(post, fmt, sf):
+		def enum(raw):
+			val = post(raw)
+			if isinstance(val, int):
+				return fmt[val]
+			return val * sf if sf != 1 else val
+		return enum
+
+	def _compile(self, values):
+		"""compile a sorted batch into (address, length, struct, keys, callables)
+
+		The whole response block is decoded by a single unpack_from, every value
+		is then passed through its callable (vtype, enum lookup and scaling).
+		"""
+		if values == []:
+			return None
 
 		addr_min = values[0][1]
 		addr_max = values[-1][1] + values[-1][2]
 		offset = addr_min
-		length = addr_max - addr_min
-#		print(f"addr min: {addr_min}, max: {addr_max}")
 
-		try:
-			if rtype == registerType.INPUT:
-				data = self._read_input_registers(offset, length)
-			elif rtype == registerType.HOLDING:
-				data = self._read_holding_registers(offset, length)
-			else:
-				raise NotImplementedError(rtype)
+		layout = [self.byteorder]
+		keys = []
+		posts = []
+
+		for v in values:
+			k, address, length, rtype, dtype, vtype, label, fmt, sf = v
+			nbytes = length * self.bytesperregister
+
+			if address > offset:
+				layout.append(f"{(address - offset) * self.bytesperregister}x")
+				offset = address
+			elif address < offset:
+				raise ValueError(f"{k}: can't move from addr {offset} back to {address}")
+
+			try:
+				f, post = self._compile_value(dtype, vtype, nbytes)
+			except Exception as e:
+				logging.error(f"Error compiling: {v}, error:{e}")
+				layout.append(f"{nbytes}x")
+				offset += length
+				continue
 
-			if not data:
-				return results
-
-			for v in values:
-				k, address, length, rtype, dtype, vtype, label, fmt, sf = v
-
-				if address > offset:
-					skip_bytes = address - offset
-					offset += skip_bytes
-					data.skip_bytes(skip_bytes * 2)
-				elif address < offset:
-					raise ValueError(f"{k}: can't move from addr {offset} back to {address}")
-					
-				try:
-					val = self._decode_value(data, (length * self.bytesperregister), dtype, vtype)
-				except Exception as e:
-					logging.error(f"Error decoding: {v}, data, error:{e}")
-					continue
+			if isinstance(fmt, list):
+				post = self._compile_enum(post, fmt, sf)
+			elif sf != 1:
+				post = lambda raw, post=post, sf=sf: post(raw) * sf
 
-				if isinstance(fmt, list) and isinstance(val, int):
-					val = fmt[val]
-				elif sf != 1:
-					val *= sf
+			layout.append(f)
+			keys.append(k)
+			posts.append(post)
+			offset += length
 
-				results[k] = val
-				offset += length
-		except NotImplementedError:
-		    raise
+		return addr_min, addr_max - addr_min, struct.Struct("".join(layout)), tuple(keys), tuple(posts)
 
+	def _decode_block(self, plan, registers):
+		address, length, layout, keys, posts = plan
+		raw = struct.pack(f">{length}H", *registers)
+
+		results = {}
+		for k, post, val in zip(keys, posts, layout.unpack_from(raw)):
+			try:
+				results[k] = post(val)
+			except Exception as e:
+				self.metrics.decode_error()
+				logging.error(f"Error decoding: {k}, data, error:{e}")
+
+		return results
+
+	def _block_results(self, plan, rtype, registers, started):
+		"""decoded values of a read block, holding registers are cached"""
+		if not registers:
+			return {}
+
+		results = self._decode_block(plan, registers)
+		if rtype == registerType.HOLDING:
+			self._cache_store(results, started)
 		return results
 
+	def _read_compiled(self, plan, rtype):
+		if plan is None: # if empty request
+			return {}
+
+		started = time.monotonic()
+		split = self._splits.get((rtype, plan[0], plan[1], plan[3]))
+		if split is None:
+			try:
+				registers = self._read_raw(plan[0], plan[1], rtype)
+			except RequestRejected as e:
+				split = self._split(plan, rtype, e)
+
+		if split is not None:
+			results = {}
+			for p in split:
+				results.update(self._read_compiled(p, rtype))
+			return results
+
+		return self._block_results(plan, rtype, registers, started)
+
+	def _read_all(self, values, rtype):
+		return self._read_compiled(self._compile(values), rtype)
+
+	def _split(self, plan, rtype, rejected):
+		"""plans replacing a rejected request, () if it can't be split
+
+		A short answer may be a transmission fault: the limit is only lowered to
+		its length if the next short answer of the type has the same length, and
+		the split is only kept for the following reads then. Exceptions are kept.
+		"""
+		logging.info(f"{self.model} unit {self.unit}: {rejected}")
+
+		keep = True
+		if rejected.received:
+			keep = self._shorts.get(rtype) == rejected.received
+			self._shorts[rtype] = rejected.received
+			if keep:
+				self._learn_limit(rtype, rejected.received)
+		elif rejected.code == 3:
+			self._learn_limit(rtype, plan[1] // 2) # estimate, see probe_limits()
+
+		registers = [e for e in self.registers.sorted(rtype) if e[0] in plan[3]]
+		if len(registers) < 2:
+			logging.warning(f"{self.model} unit {self.unit}: {plan[3]} can't be read")
+			return () # not kept, read again next time
+
+		batches = self._plan_batches(registers, self._limit(rtype))
+		if len(batches) < 2:
+			mid = len(registers) // 2
+			batches = [registers[:mid], registers[mid:]]
+
+		split = tuple(self._compile(b) for b in batches)
+		if keep:
+			self._splits[(rtype, plan[0], plan[1], plan[3])] = split
+		return split
+
+	def _limit(self, rtype):
+		return self.limits.get(rtype, self.batchlimit)
+
+	def _learn_limit(self, rtype, limit):
+		"""lower the (estimated, not persisted) limit, never below the longest register"""
+		if limit < max(e[2] for e in self.registers.sorted(rtype)) or limit >= self._limit(rtype):
+			return
+
+		logging.info(f"{self.model} unit {self.unit}: reading at most {limit} {rtype.name} registers per request")
+		self.limits[rtype] = limit
+		self._plans.clear()
+		self._splits.clear()
+
+	def _probe_steps(self, rtype):
+		"""bisect the request size of `rtype`: yields (address, length) to read and
+		is sent the answer (registers, None or RequestRejected), see probe_limits()"""
+		entries = self.registers.sorted(rtype)
+		if rtype in self._probed or not entries:
+			return
+
+		address = entries[0][1]
+		lo, hi = 0, self.maxrequest + 1		# lo answered, hi didn't
+		while hi - lo > 1:
+			mid = (lo + hi) // 2
+			shorts = []
+			while True:
+				answer = yield address, mid
+				if not isinstance(answer, RequestRejected) or not answer.received:
+					break
+				if answer.received in shorts:
+					break # the same short answer again: the device limit, not a fault
+				if len(shorts) == self.probeshorts:
+					return # no two alike, a bad link: try again later
+				shorts.append(answer.received)
+
+			if answer is None:
+				return # no answer at all, try again later
+			if not isinstance(answer, RequestRejected):
+				lo = mid
+			elif answer.code == 2:
+				return # an address of the range is not implemented: no size limit
+			else:
+				hi = min(mid, answer.received + 1) if answer.received else mid
+
+		if lo:
+			self.limits[rtype] = lo
+			self._probed.add(rtype)
+			logging.info(f"{self.model} unit {self.unit}: {lo} {rtype.name} registers per request")
+
+	def _probe_done(self):
+		self._plans.clear()
+		self._splits.clear()
+		self.save_cache()
+		return dict(self.limits)
+
+	def probe_limits(self):
+		"""find the largest request (up to maxrequest) per register type, if not known exactly yet
+
+		Bisects the length of a read from the first register of each type, the
+		result replaces `batchlimit` in the batch planner. Only exception 3 and
+		short answers bound the size, a short answer only if it is repeated with
+		the same length. Exception 2 (an unimplemented address in the range) ends
+		the probe of that type without a result.
+		"""
+		for rtype in registerType:
+			steps = self._probe_steps(rtype)
+			try:
+				address, length = next(steps)
+				while True:
+					try:
+						answer = self._read_raw(address, length, rtype)
+					except RequestRejected as e:
+						answer = e
+					address, length = steps.send(answer)
+			except StopIteration:
+				pass
+
+		return self._probe_done()
+
 	def _write(self, value, data):
 		address, length, rtype, dtype, vtype, label, fmt, sf = value
 
@@ -312,6 +837,104 @@ class ModBusDev:
 		except NotImplementedError:
 		    raise
 
+	# ----------------------------------------------------------------------------------	
+	def _cache_store(self, results, started=None):
+		"""cache read values, except those written after the read `started` (may be stale)"""
+		now = time.monotonic()
+		changed = False
+
+		for k, v in results.items():
+			ttl = self.cachettl.get(k)
+			if not ttl:
+				continue
+			if started is not None and self._written.get(k, -math.inf) >= started:
+				continue
+
+			if k in self.cachepersist and self._cache.get(k, (None,))[0] != v:
+				changed = True
+			self._cache[k] = (v, now + ttl)
+
+		if changed:
+			self.save_cache()
+
+	def _cache_lookup(self, items):
+		"""split a frozenset of keys into (fresh cached values, keys to read)"""
+		if not self._cache:
+			return {}, items
+
+		now = time.monotonic()
+		cached = {}
+		for k in items:
+			entry = self._cache.get(k)
+			if entry and entry[1] > now:
+				cached[k] = entry[0]
+
+		if cached:
+			items = items.difference(cached)
+		return cached, items
+
+	def _cache_invalidate(self, address, length):
+		now = time.monotonic()
+		for k in self.registers.overlapping(registerType.HOLDING, address, length):
+			self._cache.pop(k, None)
+			self._written[k] = now
+
+	def cache_clear(self):
+		self._cache.clear()
+
+	def _load_cachefile(self):
+		try:
+			with open(self.cachefile) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def load_cache(self):
+		"""restore persisted registers of this device from `cachefile`
+
+		Only the serial number is read from the device.
+		"""
+		if not self.cachefile or not self.serialkey:
+			return False
+
+		return self._restore_cache(self.read_list([self.serialkey]).get(self.serialkey))
+
+	def _restore_cache(self, serial):
+		stored = self._load_cachefile()
+		if serial not in stored:
+			return False
+
+		now = time.monotonic()
+		for k, v in stored[serial].items():
+			if k in self.registers and k in self.cachepersist:
+				self._cache[k] = (v, now + self.cachettl.get(k, math.inf))
+
+		limits = {registerType[r]: n for r, n in stored[serial].get("_limits", {}).items()}
+		if limits:
+			self.limits.update(limits)
+			self._probed.update(limits)
+			self._plans.clear()
+		return True
+
+	def save_cache(self):
+		serial = self._cache.get(self.serialkey, (None,))[0]
+		if not self.cachefile or serial is None:
+			return
+
+		stored = self._load_cachefile()
+		values = stored.setdefault(serial, {})
+		values.update({k: self._cache[k][0] for k in self.cachepersist if k in self._cache})
+		if self._probed:
+			values["_limits"] = {r.name: self.limits[r] for r in self._probed}
+
+		try:
+			tmp = f"{self.cachefile}.tmp"
+			with open(tmp, "w") as f:
+				json.dump(stored, f, indent=1)
+			os.replace(tmp, self.cachefile)
+		except OSError as e:
+			logging.error(f"Error writing {self.cachefile}: {e}")
+
 	def connect(self):
 		return self.client.connect()
 
@@ -322,17 +945,17 @@ class ModBusDev:
 		return self.client.is_socket_open()
 
 	def get_scaling(self, key):
-		address, length, rtype, dtype, vtype, label, fmt, sf = self.registers[key]
-		return sf
+		return self.registers[key].sf
 
 	def read(self, key, scaling=True):
 		if key not in self.registers:
 		    raise KeyError(key)
 
-		if scaling:
-		    return self._read(self.registers[key]) * self.get_scaling(key)
-		else:
-		    return self._read(self.registers[key])
+		with self.buslock.priority(DEMAND):
+		    if scaling:
+		        return self._read(self.registers[key]) * self.get_scaling(key)
+		    else:
+		        return self._read(self.registers[key])
 
 	def write(self, key, data):
 		if key not in self.registers:
@@ -340,58 +963,219 @@ class ModBusDev:
 
 		return self._write(self.registers[key], data / self.get_scaling(key))
 
-	def read_all(self, rtype=registerType.INPUT):
-		registers = [(k, *v) for k, v in self.registers.items() if (v[2] == rtype)]
-		registers.sort(key=lambda a: a[1]) # sort by register addr
-		results = {}
+	def _encode_many(self, values):
+		"""encode {key: value} into address sorted writes [(address, registers, keys), ...]
+
+		Adjacent registers are merged into one write of at most `writelimit` registers.
+		RAW registers take a list of register values or what their `encoders` entry takes.
+		"""
+		items = []
+		for k, data in values.items():
+			if k not in self.registers:
+			    raise KeyError(k)
+
+			r = self.registers[k]
+			if r.rtype != registerType.HOLDING:
+			    raise NotImplementedError(r.rtype)
+
+			if k in self.encoders:
+			    data = self.encoders[k](data)
+			if r.sf != 1 and r.dtype != registerDataType.RAW:
+			    data = data / r.sf
+
+			registers = self._encode_value(data, r.dtype)
+			if len(registers) != r.length:
+			    raise ValueError(f"{k}: {len(registers)} registers given, {r.length} expected")
+
+			items.append((r.address, k, registers))
+		items.sort()
+
+		writes = []
+		for address, k, registers in items:
+			if writes:
+				start, regs, keys = writes[-1]
+				end = start + len(regs)
+
+				if address < end:
+				    raise ValueError(f"{k} overlaps {keys[-1]}")
+				if address == end and len(regs) + len(registers) <= self.writelimit:
+				    regs.extend(registers)
+				    keys.append(k)
+				    continue
+
+			writes.append((address, list(registers), [k]))
+
+		return writes
+
+	def _verify_block(self, plan, registers, writes, values, ok):
+		"""compare read back `registers` of a plan with the written registers and
+		numeric values (scaled) with the requested `values`"""
+		decoded = self._decode_block(plan, registers) if registers is not None else {}
+
+		for address, regs, keys in writes:
+			for k in keys:
+				r = self.registers[k]
+				if not plan[0] <= r.address < plan[0] + plan[1]:
+					continue
 
-		startadr = 0
-		batches = []
-		batchi = []
-		for v in registers:
-			addrend = v[1] + v[2]
-			if addrend > (self.batchlimit + startadr):
-				startadr = v[1]
-				batches.append(batchi)
-				batchi = []
-			
-			batchi.append(v)
+				offset = r.address - address
+				if registers is None or registers[r.address - plan[0]:r.address - plan[0] + r.length] != regs[offset:offset + r.length]:
+					ok[k] = False
+					continue
+
+				v = values[k]
+				if isinstance(r.fmt, str) and r.dtype != registerDataType.RAW and isinstance(v, (int, float)):
+					if not isinstance(decoded.get(k), (int, float)) or not math.isclose(decoded[k], v, rel_tol=1e-9, abs_tol=1e-9):
+						ok[k] = False # e.g. not a multiple of the scaling
+
+	@staticmethod
+	def _write_ok(result):
+		return result is not None and not result.isError()
+
+	def write_many(self, values, verify=False):
+		"""write several holding registers {key: value} with as few requests as possible
+
+		With verify=True the registers are read back in one batched read and compared.
+		Returns {key: True if written (and verified)}.
+		"""
+		writes = self._encode_many(values)
+		ok = {}
+
+		with self.buslock.priority(CONTROL):
+			for address, registers, keys in writes:
+				ok.update(dict.fromkeys(keys, self._write_ok(self._write_holding_register(address, registers))))
+
+			if verify:
+				for plan in self._plan(frozenset(ok), registerType.HOLDING):
+					self._verify_block(plan, self._read_raw(plan[0], plan[1], registerType.HOLDING), writes, values, ok)
+
+		return ok
+
+	def _request_cost(self, length):
+		"""estimated bus time in s for reading `length` registers in one request"""
+		if self.mode is connectionType.RTU:
+			bits = 1 + 8 + (1 if self.parity in ["E", "O"] else 0) + self.stopbits
+			chartime = bits / self.baud
 		else:
-			batches.append(batchi)
-	
-		for batch in batches:
-		    results.update(self._read_all(batch, rtype))
+			chartime = 8 / 10e6
+
+		frame = self.frameoverhead + self.framegap + length * self.bytesperregister
+		return self.turnaround + frame * chartime
+
+	def _plan_batches(self, registers, limit):
+		"""split address sorted registers into the cheapest set of requests of at most `limit` registers
+
+		Gap registers are read along if that is cheaper than another request.
+		"""
+		n = len(registers)
+		best = [0.0] + [math.inf] * n
+		cut = [0] * (n + 1)
+
+		for i in range(1, n + 1):
+			end = 0
+			for j in range(i - 1, -1, -1):
+				end = max(end, registers[j][1] + registers[j][2])
+				span = end - registers[j][1]
+				if span > limit and j < i - 1:
+					break
+
+				cost = best[j] + self._request_cost(span)
+				if cost < best[i]:
+					best[i] = cost
+					cut[i] = j
+
+		batches = []
+		i = n
+		while i > 0:
+			batches.append(registers[cut[i]:i])
+			i = cut[i]
+		batches.reverse()
+
+		return batches
+
+	def _plan(self, items, rtype):
+		"""cached, compiled batch plan for a frozenset of keys (None: all registers)"""
+		key = (items, rtype)
+		plan = self._plans.get(key)
+
+		if plan is not None:
+			try:
+				self._plans.move_to_end(key)
+			except KeyError: # dropped by another thread meanwhile
+				pass
+			return plan
+
+		registers = self.registers.sorted(rtype) # sorted by register addr
+		if items is not None:
+			registers = [e for e in registers if e[0] in items]
+
+		plan = self._plans[key] = tuple(self._compile(batch) for batch in self._plan_batches(registers, self._limit(rtype)))
+		while len(self._plans) > self.maxplans:
+			try:
+				self._plans.popitem(last=False)
+			except KeyError:
+				break
+		return plan
+
+	def _read_plans(self, plans):
+		"""read (plan, rtype) pairs, the cycle is accounted in self.metrics"""
+		results = {}
+		batches = []
+		start = time.monotonic()
+
+		for plan, rtype in plans:
+			t = time.monotonic()
+			results.update(self._read_compiled(plan, rtype))
+			batches.append((rtype.name, plan[0], plan[1], time.monotonic() - t))
+
+		self.metrics.cycle_done(time.monotonic() - start, batches)
+		return results
+
+	def read_all(self, rtype=registerType.INPUT):
+		results = self._read_plans((plan, rtype) for plan in self._plan(None, rtype))
 
 		results = self._clean_data(results)
 		return results
 
 	# ----------------------------------------------------------------------------------	
-	def read_list(self, items):
-	
-		reglist = [(k, *v) for k, v in self.registers.items() if (k in items)]
-			
-		results = {}
-		for rtype in registerType:
-			registers = [v for v in reglist if (v[3] == rtype)]
-			registers.sort(key=lambda a: a[1]) # sort by register addr
-
-			startadr = 0
-			batches = []
-			batchi = []
-			for v in registers:
-				addrend = v[1] + v[2]
-				if addrend > (self.batchlimit + startadr):
-					startadr = v[1]
-					batches.append(batchi)
-					batchi = []
-				
-				batchi.append(v)
-			else:
-				batches.append(batchi)
-		
-			for batch in batches:
-			    results.update(self._read_all(batch, rtype))
+	def _list_plans(self, items, cached):
+		"""(cached values, (plan, rtype) pairs reading the other keys of `items`)"""
+		if cached:
+			results, items = self._cache_lookup(frozenset(items))
+		else:
+			results, items = {}, frozenset(items)
+
+		return results, [(plan, rtype) for rtype in registerType for plan in self._plan(items, rtype)]
+
+	def read_list(self, items, cached=True):
+		"""{key: value}, cached=False reads cached holding registers from the device too"""
+		results, plans = self._list_plans(items, cached)
+		results.update(self._read_plans(plans))
 
 		results = self._clean_data(results)
 		return results
-		
+
+	def stream(self, keys, interval, count=None):
+		"""yield a Sample of `keys` every `interval` s
+
+		The ticks are fixed on the monotonic clock, so the period doesn't drift by
+		the read time. If a read or the consumer takes longer than a period, the
+		missed ticks are skipped and reported in the next sample.
+		"""
+		keys = frozenset(keys)
+		start = time.monotonic()
+		tick = skipped = n = 0
+
+		while count is None or n < count:
+			wait = start + tick * interval - time.monotonic()
+			if wait > 0:
+				time.sleep(wait)
+
+			t = time.time()
+			t0 = time.monotonic()
+			values = self.read_list(keys)
+
+			yield Sample(t, values, time.monotonic() - t0, skipped)
+			n += 1
+
+			tick, skipped = next_tick(start, interval, tick)
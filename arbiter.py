@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Priority arbitration of one bus (dev.buslock, shared by all units on a client).
+#
+# Every request takes the bus for the single transaction. When it is released
+# the most urgent waiting request goes next (FIFO within a priority), so a
+# control write waits at most for the request currently on the wire, never
+# for the rest of a poll cycle. Poll cycles yield between their batches.
+#
+#   with dev.buslock.priority(MBD.DEMAND):     # priority of this thread's requests
+#       dev.read_list(["Bat_SOC"])
+#
+#   with dev.buslock as wait:                  # one transaction, wait: s queued
+#       dev.client.read_input_registers(...)
+
+import time
+import heapq
+import itertools
+import threading
+import contextlib
+
+CONTROL = 0		# writes
+DEMAND = 1		# on-demand reads (MQTT, regdump, ...)
+POLL = 2		# background polling
+
+NAMES = {CONTROL: "control", DEMAND: "demand", POLL: "poll"}
+
+
+class BusArbiter:
+	"""reentrant bus lock granting waiters by priority"""
+
+	def __init__(self):
+		self.cond = threading.Condition(threading.Lock())
+		self.owner = None
+		self.depth = 0
+		self.waiting = []		# heap of (priority, seq)
+		self.seq = itertools.count()
+		self.local = threading.local()
+
+	@contextlib.contextmanager
+	def priority(self, priority):
+		"""run the requests of this thread with `priority` (nested: the more urgent one wins)"""
+		old = self.current()
+		self.local.priority = min(old, priority)
+		try:
+			yield
+		finally:
+			self.local.priority = old
+
+	def current(self):
+		return getattr(self.local, "priority", POLL)
+
+	def acquire(self, priority=None):
+		"""wait for the bus, returns the time waited in s"""
+		me = threading.get_ident()
+		with self.cond:
+			if self.owner == me:
+				self.depth += 1
+				return 0.0
+
+			entry = (self.current() if priority is None else priority, next(self.seq))
+			heapq.heappush(self.waiting, entry)
+			start = time.monotonic()
+
+			while self.owner is not None or self.waiting[0] != entry:
+				self.cond.wait()
+
+			heapq.heappop(self.waiting)
+			self.owner = me
+			self.depth = 1
+			return time.monotonic() - start
+
+	def release(self):
+		with self.cond:
+			if self.owner != threading.get_ident():
+				raise RuntimeError("release of a bus not owned")
+
+			self.depth -= 1
+			if self.depth == 0:
+				self.owner = None
+				self.cond.notify_all()
+
+	def queued(self):
+		"""waiting requests per priority name"""
+		with self.cond:
+			counts = dict.fromkeys(NAMES.values(), 0)
+			for priority, seq in self.waiting:
+				name = NAMES.get(priority, str(priority))
+				counts[name] = counts.get(name, 0) + 1
+			return counts
+
+	def __enter__(self):
+		return self.acquire()
+
+	def __exit__(self, *exc):
+		self.release()
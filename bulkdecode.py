@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Vectorized decoding of stored raw register blocks (needs numpy).
+#
+#   snapshots = numpy.array(...)  # samples x registers, uint16, starting at `start`
+#   cols = bulkdecode.decode(snapshots, inv.registers, start=1000)
+#   cols["Bat_SOC"], cols["Bat_P_charge"], ...
+
+import numpy as np
+
+import ModBusDev as MBD
+from pymodbus.constants import Endian
+
+rt = MBD.registerType
+dt = MBD.registerDataType
+
+
+def _words(snapshots, column, length, byteorder):
+	w = snapshots[:, column:column + length]
+	if byteorder == Endian.Little:
+		w = w.byteswap()
+	return w
+
+
+def _combine32(w, wordorder):
+	hi, lo = w[:, 0], w[:, 1]
+	if wordorder == Endian.Little:
+		hi, lo = lo, hi
+	return (hi.astype(np.uint32) << 16) | lo
+
+
+def decode_column(snapshots, column, length, dtype, byteorder=Endian.Big, wordorder=Endian.Big):
+	"""decode one value from all samples, returns a numpy array or None"""
+	if dtype == dt.STRING:
+		# characters in register order, the byte order only applies to numbers
+		w = snapshots[:, column:column + length]
+		return np.ascontiguousarray(w.astype(">u2")).view(f"S{length * 2}")[:, 0]
+
+	w = _words(snapshots, column, length, byteorder)
+
+	if dtype == dt.UINT16 and length == 1:
+		return w[:, 0].copy()
+	elif dtype == dt.INT16 and length == 1:
+		return w[:, 0].view(np.int16).copy()
+	elif dtype in [dt.UINT32, dt.INT32, dt.FLOAT32] and length == 2:
+		u = _combine32(w, wordorder)
+		if dtype == dt.INT32:
+			return u.view(np.int32)
+		elif dtype == dt.FLOAT32:
+			return u.view(np.float32)
+		return u
+	else:
+		return None
+
+
+def decode(snapshots, registers, start=0, rtype=rt.INPUT, byteorder=Endian.Big, wordorder=Endian.Big):
+	"""decode a (samples x registers) uint16 array into typed columns
+
+	`registers` is a ModBusDev register map (e.g. growatt.SPH.registers),
+	column 0 of `snapshots` holds register `start`. Only registers of `rtype`
+	that lie completely inside the block are decoded. Scale factors are applied
+	(float64 result), enums stay integer codes, HEX and RAW values are skipped.
+	"""
+	snapshots = np.asarray(snapshots, dtype=np.uint16)
+	if snapshots.ndim != 2:
+		raise ValueError(f"expected samples x registers, got shape {snapshots.shape}")
+
+	end = start + snapshots.shape[1]
+	columns = {}
+
+	for k, (address, length, rtype_, dtype, vtype, label, fmt, sf) in registers.items():
+		if rtype_ != rtype or address < start or address + length > end:
+			continue
+
+		col = decode_column(snapshots, address - start, length, dtype, byteorder, wordorder)
+		if col is None:
+			continue
+
+		if sf != 1 and not isinstance(fmt, list) and col.dtype.kind in "iuf":
+			col = col.astype(np.float64) * sf # an integer sf would keep the uint16 and wrap
+		elif vtype is float and col.dtype.kind in "iu":
+			col = col.astype(np.float64)
+
+		columns[k] = col
+
+	return columns
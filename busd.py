@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# One process owns the bus, any number of local tools read from it.
+#
+# The owner (busd.py standalone or pv2mqtt) polls the device and writes the
+# latest decoded values into a memory mapped table (/dev/shm, seqlock: the
+# sequence number is odd while the table is written), readers map the table
+# and cost no bus transaction. Reads, raw range reads and writes go over a
+# UNIX socket as json lines and share the bus with the polling (coalesced,
+# see readrpc.py, writes with CONTROL priority).
+#
+#   busd.py /dev/ttyUSB0                       # standalone owner
+#   busd.py /dev/ttyUSB0 --gateway 5502        # and Modbus TCP clients, see gateway.py
+#   reader.py --bus                            # client mode of the tools
+#   regdump.py --bus
+#
+#   bus = BusClient()
+#   bus.snapshot().values["PV_P"]             # from the table
+#   bus.read(["Bat_SOC"], max_age=5)           # over the socket
+#   bus.write_many({"Active_P_Rate": 50}, verify=True)
+#
+# Socket requests: {"op": "read", "keys": [...], "ranges": [...], "max_age": s},
+# {"op": "write", "values": {...}, "verify": bool}, {"op": "info"}
+
+import os
+import json
+import mmap
+import time
+import socket
+import struct
+import logging
+import threading
+import socketserver
+import collections
+
+import ModBusDev as MBD
+import readrpc
+
+SOCKET = "/tmp/growatt.sock"
+TABLE = "/dev/shm/growatt.tbl"
+
+MAGIC = b"GWTBL\x00\x01\x00"
+HEADER = struct.Struct(">8sQdI")		# magic, sequence number, time, json length
+SIZE = 1 << 18
+
+Snapshot = collections.namedtuple("Snapshot", "seq time values times")
+
+
+class SnapshotTable:
+	"""latest values {key: value} with their times, one writer, any number of readers"""
+
+	def __init__(self, path=TABLE, writer=False, size=SIZE):
+		self.path = path
+		self.writer = writer
+
+		if writer:
+			# a new file, readers still mapping an old one must not see it shrink (SIGBUS)
+			tmp = f"{path}.{os.getpid()}"
+			fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+			try:
+				os.ftruncate(fd, size)
+				self.map = mmap.mmap(fd, size)
+			finally:
+				os.close(fd)
+
+			self.seq = 0
+			self.values = {}
+			self.times = {}
+			empty = b'{"values": {}, "times": {}}'
+			self.map[HEADER.size:HEADER.size + len(empty)] = empty
+			HEADER.pack_into(self.map, 0, MAGIC, 0, 0.0, len(empty))
+			os.replace(tmp, path)
+			self.inode = os.stat(path).st_ino
+		else:
+			with open(path, "rb") as f:
+				self.inode = os.fstat(f.fileno()).st_ino
+				self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+			if self.map[:len(MAGIC)] != MAGIC:
+				raise ValueError(f"{path} is not a value table")
+
+	def update(self, values, t=None):
+		"""merge `values` into the table"""
+		t = time.time() if t is None else t
+		self.values.update(values)
+		self.times.update(dict.fromkeys(values, t))
+
+		data = json.dumps({"values": self.values, "times": self.times}, default=str).encode()
+		if HEADER.size + len(data) > len(self.map):
+			raise ValueError(f"{len(data)} bytes don't fit into {self.path}")
+
+		struct.pack_into(">Q", self.map, 8, self.seq + 1) # odd: being written
+		self.map[HEADER.size:HEADER.size + len(data)] = data
+		struct.pack_into(">dI", self.map, 16, t, len(data))
+		self.seq += 2
+		struct.pack_into(">Q", self.map, 8, self.seq) # even again, after everything else
+
+	def read(self, attempts=100):
+		"""consistent Snapshot of the table"""
+		for i in range(attempts):
+			magic, seq, t, n = HEADER.unpack_from(self.map, 0)
+			if seq % 2 == 0:
+				data = self.map[HEADER.size:HEADER.size + n]
+				if struct.unpack_from(">Q", self.map, 8)[0] == seq:
+					try:
+						d = json.loads(data)
+						return Snapshot(seq, t, d["values"], d["times"])
+					except ValueError: # torn read of a length written with another sequence
+						pass
+			time.sleep(0.001)
+
+		raise TimeoutError(f"{self.path} is written continuously")
+
+	def stale(self):
+		"""True if the table was replaced by a new owner"""
+		try:
+			return os.stat(self.path).st_ino != self.inode
+		except FileNotFoundError:
+			return True
+
+	def close(self):
+		self.map.close()
+		if self.writer and not self.stale():
+			os.remove(self.path)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				ans = self.server.bus.handle(json.loads(line))
+			except Exception as e:
+				ans = {"error": f"{type(e).__name__}: {e}"}
+
+			self.wfile.write(json.dumps(ans, default=str).encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+class BusServer:
+	"""serves requests on a UNIX socket, `writable`: keys that may be written (None: dev.writable)"""
+
+	def __init__(self, dev, path=SOCKET, rpc=None, writable=None, timeout=30):
+		self.dev = dev
+		self.path = path
+		self.rpc = rpc or readrpc.ReadCoalescer(dev, reply=None)
+		self.writable = set(dev.writable if writable is None else writable)
+		self.timeout = timeout
+
+		if os.path.exists(path):
+			os.remove(path) # left over by a previous owner
+		self.server = _Server(path, _Handler)
+		self.server.bus = self
+		os.chmod(path, 0o660)
+
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def handle(self, msg):
+		op = msg.get("op", "read")
+
+		if op == "read":
+			return self.rpc.call(msg, self.timeout)
+
+		if op == "write":
+			values = msg["values"]
+			for k in values:
+				if k not in self.writable:
+					raise KeyError(f"{k} is not a writable register")
+			return {"id": msg.get("id"), "ok": self.dev.write_many(values, verify=msg.get("verify", False))}
+
+		if op == "info":
+			return {
+				"id": msg.get("id"),
+				"device": repr(self.dev),
+				"limits": {r.name: n for r, n in self.dev.limits.items()},
+				"offline": self.dev.offline(),
+				"metrics": self.dev.metrics.snapshot(),
+				"read_rpc": self.rpc.stats(),
+			}
+
+		raise ValueError(f"unknown op {op}")
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		os.remove(self.path)
+
+
+class BusClient:
+	def __init__(self, socket=SOCKET, table=TABLE, timeout=30):
+		self.socket = socket
+		self.table = table
+		self.timeout = timeout
+
+		self.lock = threading.Lock()
+		self.sock = None
+		self.file = None
+		self._table = None
+
+	def __repr__(self):
+		return f"BusClient({self.socket}, {self.table})"
+
+	def snapshot(self):
+		"""latest values of the owner, no bus transaction"""
+		if self._table is not None and self._table.stale():
+			self._table.close()
+			self._table = None
+		if self._table is None:
+			self._table = SnapshotTable(self.table)
+		return self._table.read()
+
+	def request(self, msg):
+		with self.lock:
+			if self.sock is None:
+				self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				self.sock.settimeout(self.timeout)
+				self.sock.connect(self.socket)
+				self.file = self.sock.makefile("rb")
+
+			try:
+				self.sock.sendall(json.dumps(msg).encode() + b"\n")
+				line = self.file.readline()
+			except OSError:
+				self.close()
+				raise
+
+		if not line:
+			self.close()
+			raise ConnectionError(f"{self.socket} closed the connection")
+
+		ans = json.loads(line)
+		if "error" in ans:
+			raise RuntimeError(ans["error"])
+		return ans
+
+	def read(self, keys, max_age=0):
+		"""{key: value} of the keys that could be read"""
+		return self.request({"op": "read", "keys": list(keys), "max_age": max_age})["values"]
+
+	def read_raw(self, rtype, address, count, max_age=0):
+		"""registers or None"""
+		rtype = getattr(rtype, "name", rtype)
+		ans = self.request({"op": "read", "ranges": [{"rtype": rtype, "address": address, "count": count}], "max_age": max_age})
+		return ans["ranges"][0]["registers"] if ans["ranges"] else None
+
+	def write_many(self, values, verify=False):
+		return self.request({"op": "write", "values": values, "verify": verify})["ok"]
+
+	def info(self):
+		return self.request({"op": "info"})
+
+	def stream(self, keys, interval, count=None):
+		"""Sample of `keys` from the table every `interval` s, like ModBusDev.stream()"""
+		start = time.monotonic()
+		tick = skipped = n = 0
+
+		while count is None or n < count:
+			wait = start + tick * interval - time.monotonic()
+			if wait > 0:
+				time.sleep(wait)
+
+			snap = self.snapshot()
+			yield MBD.Sample(snap.time, {k: snap.values[k] for k in keys if k in snap.values}, 0.0, skipped)
+			n += 1
+
+			tick, skipped = MBD.next_tick(start, interval, tick)
+
+	def close(self):
+		if self.sock:
+			self.file.close()
+			self.sock.close()
+		self.sock = self.file = None
+
+
+# =========================================================================================
+
+def main():
+	import sys
+	import signal
+	import argparse
+	import growatt
+	import scheduler
+
+	parser = argparse.ArgumentParser(description="own the RS485 bus and serve the values to local tools")
+	parser.add_argument("port", nargs="?", default="/dev/serial/by-path/platform-3f980000.usb-usb-0:1.3:1.0-port0", help="RS485 device of the inverter")
+	parser.add_argument("--socket", default=SOCKET, help=f"UNIX socket for requests (default {SOCKET})")
+	parser.add_argument("--table", default=TABLE, help=f"shared value table (default {TABLE})")
+	parser.add_argument("--gateway", type=int, metavar="PORT", help="serve Modbus TCP on PORT too, see gateway.py")
+	parser.add_argument("--gateway-host", default="127.0.0.1", help="interface of the gateway (default 127.0.0.1, 0.0.0.0: all, no authentication!)")
+	parser.add_argument("--max-age", type=float, default=5, help="s, age of the gateway register image (default 5)")
+	parser.add_argument("--keys", help="comma separated keys to poll (default: all registers)")
+	parser.add_argument("--cachefile", help="persisted identity registers, see ModBusDev.load_cache()")
+	parser.add_argument("-v", "--verbose", action="store_const", dest="loglevel", const=logging.INFO, default=logging.WARNING)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=args.loglevel, format="%(levelname)s:	%(message)s")
+
+	dev = growatt.SPH(device=args.port, stopbits=1, parity="N", baud=9600, timeout=1, unit=1, cachefile=args.cachefile)
+	if args.cachefile:
+		dev.load_cache()
+	logging.info(f"{dev}, registers per request: {dev.probe_limits()}")
+
+	signal.signal(signal.SIGTERM, lambda *a: sys.exit()) # clean up socket and table
+
+	keys = args.keys.split(",") if args.keys else list(dev.registers)
+	poller = scheduler.PollScheduler(dev, keys)
+	table = SnapshotTable(args.table, writer=True)
+	server = BusServer(dev, args.socket)
+	if args.gateway:
+		import gateway
+		gateway.Gateway(dev, server.rpc, host=args.gateway_host, port=args.gateway, max_age=args.max_age)
+
+	try:
+		while True:
+			data = poller.poll()
+			if data == {}:
+				poller.reset()
+				time.sleep(max(0.2, dev.probe_wait()))
+				continue
+
+			if data:
+				server.rpc.observe(data)
+				table.update(data)
+			time.sleep(poller.wait(0.2))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+		table.close()
+
+
+if __name__ == "__main__":
+	main()
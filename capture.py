@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Capture of raw register responses and replay.
+#
+# With `capture=FILE` a ModBusDev appends every answered read to FILE:
+#
+#   header    b"MBCAP\x00\x01\x00"
+#   record    >dBBHH: time (unix s), unit, rtype (registerType value), address, count
+#             >{count}H: registers as received
+#
+# With `replay=FILE` the device reads from the capture instead of the bus, so
+# read_all(), read_list(), reader.py and pv2mqtt run offline on real traffic:
+#
+#   inv = growatt.SPH(device="/dev/ttyUSB0", capture="pv.cap")    # record
+#   inv = growatt.SPH(device="/dev/ttyUSB0", replay="pv.cap")     # replay
+#
+#   cap = capture.Capture("pv.cap")                                # analysis
+#   times, blocks = cap.series(1, MBD.registerType.INPUT, 0, 125)  # -> bulkdecode
+
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.register_read_message import ReadInputRegistersResponse
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from pymodbus.register_write_message import WriteMultipleRegistersResponse
+
+MAGIC = b"MBCAP\x00\x01\x00"
+RECORD = struct.Struct(">dBBHH")
+
+INPUT = 1		# registerType values
+HOLDING = 2
+
+
+class CaptureWriter:
+	"""append-only capture file, safe to share between threads"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.file = open(path, "ab")
+
+		if self.file.tell() == 0:
+			self.file.write(MAGIC)
+			self.file.flush()
+		else:
+			with open(path, "rb") as f:
+				if f.read(len(MAGIC)) != MAGIC:
+					self.file.close()
+					raise ValueError(f"{path} is not a capture file")
+
+	def record(self, unit, rtype, address, registers, t=None):
+		data = RECORD.pack(time.time() if t is None else t, unit, getattr(rtype, "value", rtype), address, len(registers))
+		data += struct.pack(f">{len(registers)}H", *registers)
+
+		with self.lock:
+			self.file.write(data)
+			self.file.flush()
+
+	def close(self):
+		with self.lock:
+			self.file.close()
+
+
+class Capture:
+	"""memory mapped capture file, records are indexed by time"""
+
+	def __init__(self, path):
+		self.path = path
+
+		with open(path, "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+		if self.map[:len(MAGIC)] != MAGIC:
+			raise ValueError(f"{path} is not a capture file")
+
+		self.times = []		# per record, ascending
+		self.offsets = []
+
+		offset = len(MAGIC)
+		while offset + RECORD.size <= len(self.map):
+			t, unit, rtype, address, count = RECORD.unpack_from(self.map, offset)
+			if offset + RECORD.size + 2 * count > len(self.map):
+				break # truncated last record
+
+			self.times.append(t)
+			self.offsets.append(offset)
+			offset += RECORD.size + 2 * count
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __getitem__(self, i):
+		"""record i as (time, unit, rtype, address, registers)"""
+		offset = self.offsets[i]
+		t, unit, rtype, address, count = RECORD.unpack_from(self.map, offset)
+		return t, unit, rtype, address, struct.unpack_from(f">{count}H", self.map, offset + RECORD.size)
+
+	def header(self, i):
+		"""record i as (time, unit, rtype, address, count) without the registers"""
+		return RECORD.unpack_from(self.map, self.offsets[i])
+
+	def find(self, t):
+		"""index of the first record at or after time t"""
+		return bisect.bisect_left(self.times, t)
+
+	def records(self, start=None, end=None):
+		"""records between the times start and end"""
+		first = 0 if start is None else self.find(start)
+		last = len(self) if end is None else self.find(end)
+		for i in range(first, last):
+			yield self[i]
+
+	def series(self, unit, rtype, address, count, start=None, end=None):
+		"""all captures of the block address:count, returns (times, [registers, ...])
+
+		The blocks can be passed to bulkdecode.decode(numpy.array(blocks), ..., start=address).
+		"""
+		rtype = getattr(rtype, "value", rtype)
+		times = []
+		blocks = []
+
+		for t, u, r, a, regs in self.records(start, end):
+			if u == unit and r == rtype and a <= address and address + count <= a + len(regs):
+				times.append(t)
+				blocks.append(regs[address - a:address - a + count])
+
+		return times, blocks
+
+	def close(self):
+		if isinstance(self.map, mmap.mmap):
+			self.map.close()
+
+
+class ReplayClient:
+	"""pymodbus client look-alike answering reads from a capture
+
+	Reads are answered by the next record (within `lookahead` records) that
+	covers the requested block, anything else looks like a timeout. With
+	`speed` the recorded time between answers is replayed (speed=10: 10x faster
+	than real time), without it the capture is replayed as fast as possible.
+	Writes are accepted and ignored.
+	"""
+
+	lookahead = 1000
+
+	def __init__(self, path, speed=None, timeout=0):
+		self.capture = Capture(path)
+		self.speed = speed
+		self.timeout = timeout
+
+		self.lock = threading.Lock()
+		self.cursor = 0
+		self.last = None
+
+	def connect(self):
+		return True
+
+	def close(self):
+		pass
+
+	def is_socket_open(self):
+		return True
+
+	def done(self):
+		"""True if the whole capture was replayed"""
+		return self.cursor >= len(self.capture)
+
+	def _find(self, unit, rtype, address, count):
+		cap = self.capture
+		for i in range(self.cursor, min(len(cap), self.cursor + self.lookahead)):
+			t, u, r, a, n = cap.header(i)
+			if u == unit and r == rtype and a <= address and address + count <= a + n:
+				return i
+		return None
+
+	def _read(self, rtype, response, address, count, unit):
+		with self.lock:
+			i = self._find(unit, rtype, address, count)
+			if i is None:
+				return ModbusIOException(f"{address}:{count} not in capture")
+
+			t, u, r, a, regs = self.capture[i]
+			self.cursor = i + 1
+
+			if self.speed and self.last is not None and t > self.last:
+				time.sleep((t - self.last) / self.speed)
+			self.last = t
+
+		return response(list(regs[address - a:address - a + count]))
+
+	def read_input_registers(self, address, count=1, unit=1, **kwargs):
+		return self._read(INPUT, ReadInputRegistersResponse, address, count, unit)
+
+	def read_holding_registers(self, address, count=1, unit=1, **kwargs):
+		return self._read(HOLDING, ReadHoldingRegistersResponse, address, count, unit)
+
+	def write_registers(self, address, values, unit=1, **kwargs):
+		return WriteMultipleRegistersResponse(address, len(values))
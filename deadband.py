@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Change detection for publishing decoded values.
+#
+# A value is significant if it moved at least its deadband away from the
+# last published value (a band of 1 passes every step of an integer
+# register, a band of 0.1 every step of a register scaled by 0.1), or if
+# it was not published for `heartbeat` s.
+# Deadbands are looked up by key first, then by the unit of the register
+# (e.g. {"W": 5, "V": 0.1}); the band is the larger of the absolute and the
+# relative (fraction of the last published value) deadband. Non numeric
+# values are significant on any change.
+#
+#   db = DeadbandFilter(inv.registers, {"W": 5, "V": 0.1}, {"Bat_SOC": 0.02})
+#   db = DeadbandFilter(inv.registers, ..., units=derived.UNITS)     # units of keys that are no registers
+#   changed = db.changes(values)
+#   publish(changed)
+#   db.commit(changed)
+
+import time
+
+
+class DeadbandFilter:
+	def __init__(self, registers, deadbands=None, relative=None, heartbeat=300, units=None):
+		self.registers = registers
+		self.units = units or {}
+		self.deadbands = deadbands or {}
+		self.relative = relative or {}
+		self.heartbeat = heartbeat
+
+		self.last = {}		# key: (value, timestamp)
+		self._bands = {}
+
+	def _band(self, k):
+		band = self._bands.get(k)
+
+		if band is None:
+			unit = self.registers[k].fmt if k in self.registers else self.units.get(k)
+			if not isinstance(unit, str):
+				unit = None
+
+			band = self._bands[k] = (
+				self.deadbands.get(k, self.deadbands.get(unit, 0)),
+				self.relative.get(k, self.relative.get(unit, 0)),
+			)
+
+		return band
+
+	def significant(self, k, last, value):
+		if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+			return value != last
+
+		absolute, relative = self._band(k)
+		band = max(absolute, relative * abs(last))
+		diff = abs(value - last)
+
+		# scaled values carry float error: 0.1 * 4 - 0.1 * 3 < 0.1
+		return diff >= band - 1e-9 * max(1, abs(last)) if band else diff != 0
+
+	def changes(self, values, now=None):
+		"""the significant part of `values`"""
+		if now is None:
+			now = time.monotonic()
+
+		changed = {}
+		for k, v in values.items():
+			last = self.last.get(k)
+
+			if last is None or now - last[1] >= self.heartbeat or self.significant(k, last[0], v):
+				changed[k] = v
+
+		return changed
+
+	def commit(self, values, now=None):
+		"""remember `values` as published"""
+		if now is None:
+			now = time.monotonic()
+
+		for k, v in values.items():
+			self.last[k] = (v, now)
+
+	def reset(self):
+		self.last.clear()
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Derived energy metrics, updated incrementally from every poll result.
+#
+# Energy counters (kWh, 0.1 kWh resolution) give the daily energies, the
+# instantaneous powers polled every second are integrated (trapezoid) for a
+# finer resolution and for energies the inverter has no counter for. Every
+# update is O(1): only the keys present in the sample are touched.
+#
+#   derived = DerivedMetrics()
+#   values = inv.read_list(keys)
+#   values.update(derived.update(values))
+#
+# Glitches (e.g. 0 read during startup) are skipped, counter resets rebase the
+# counter instead of adding the jump, the daily values restart at local midnight.
+# save() / load() keep the state over a restart on the same day.
+
+import os
+import json
+import math
+import time
+
+# counter key: daily key
+COUNTERS = {
+	"Energy_total":		"Energy_today",
+	"E_2_grid_total":	"E_2_grid_today",
+	"E_2_user_total":	"E_2_user_today",
+	"E_2_local_total":	"E_2_local_today",
+	"Bat_E_charge":		"Bat_E_charge_today",
+	"Bat_E_discharge":	"Bat_E_discharge_today",
+}
+
+# power key (W): integrated daily key (kWh)
+POWERS = {
+	"PV_P":				"PV_E_today_int",
+	"AC_P":				"AC_E_today_int",
+	"Bat_P_charge":		"Bat_E_charge_today_int",
+	"Bat_P_discharge":	"Bat_E_discharge_today_int",
+	"P_AC_2_Grid":		"E_2_grid_today_int",
+	"P_AC_2_User":		"E_2_user_today_int",
+}
+
+RATIOS = ("Self_consumption", "Self_sufficiency", "Bat_efficiency", "Bat_efficiency_today", "PV_AC_efficiency_today")
+
+UNITS = {**dict.fromkeys(COUNTERS.values(), "kWh"), **dict.fromkeys(POWERS.values(), "kWh"), **dict.fromkeys(RATIOS, "%")}
+
+
+class Counter:
+	"""daily increase of an energy counter
+
+	A decrease or an implausible jump is ignored as glitch, if it persists for
+	`confirm` samples it is a reset (or wrap) and the counter is rebased.
+	"""
+
+	def __init__(self, maxpower=20000, resolution=0.1, confirm=3):
+		self.maxpower = maxpower		# W, a faster increase is a glitch
+		self.resolution = resolution
+		self.confirm = confirm
+		self.last = None				# last accepted (value, t)
+		self.today = 0.0
+		self.suspect = 0
+		self.resets = 0
+
+	def update(self, value, t):
+		if self.last is None:
+			self.last = (value, t)
+			return
+
+		delta = value - self.last[0]
+		limit = self.maxpower * max(t - self.last[1], 0) / 3.6e6 + self.resolution
+
+		if 0 <= delta <= limit:
+			self.today += delta
+		else:
+			self.suspect += 1
+			if self.suspect < self.confirm:
+				return
+			self.resets += 1
+
+		self.suspect = 0
+		self.last = (value, t)
+
+
+class Integral:
+	"""daily energy in kWh of a power in W, intervals longer than `maxgap` s are not bridged"""
+
+	def __init__(self, maxgap=30):
+		self.maxgap = maxgap
+		self.last = None				# (value, t)
+		self.today = 0.0
+		self.gaps = 0.0					# s not integrated
+
+	def update(self, value, t):
+		if self.last is not None:
+			dt = t - self.last[1]
+			if 0 < dt <= self.maxgap:
+				self.today += (value + self.last[0]) / 2 * dt / 3.6e6
+			elif dt > 0:
+				self.gaps += dt
+
+		self.last = (value, t)
+
+
+def _ratio(part, whole, minimum=0.05):
+	"""part / whole in %, None if whole is too small to be meaningful"""
+	return round(100 * part / whole, 1) if whole >= minimum else None
+
+
+class DerivedMetrics:
+	def __init__(self, maxgap=30, maxpower=20000):
+		self.counters = {k: Counter(maxpower) for k in COUNTERS}
+		self.integrals = {k: Integral(maxgap) for k in POWERS}
+		self.day = None
+
+	def _newday(self, t):
+		day = time.strftime("%Y-%m-%d", time.localtime(t))
+		if day == self.day:
+			return
+
+		self.day = day
+		for c in self.counters.values():
+			c.today = 0.0
+		for i in self.integrals.values():
+			i.today = 0.0
+			i.gaps = 0.0
+
+	def update(self, values, t=None):
+		"""add one (partial) sample {key: value}, returns all derived values"""
+		t = time.time() if t is None else t
+		self._newday(t)
+
+		for k, v in values.items():
+			if not isinstance(v, (int, float)) or isinstance(v, bool) or math.isnan(v):
+				continue
+
+			if k in self.counters:
+				self.counters[k].update(v, t)
+			elif k in self.integrals:
+				self.integrals[k].update(v, t)
+
+		return self.values()
+
+	def values(self):
+		d = {COUNTERS[k]: c.today for k, c in self.counters.items() if c.last is not None}
+		d.update({POWERS[k]: i.today for k, i in self.integrals.items() if i.last is not None})
+
+		produced, exported = d.get("Energy_today"), d.get("E_2_grid_today")
+		if produced is not None and exported is not None:
+			d["Self_consumption"] = _ratio(produced - exported, produced)
+
+		local, imported = d.get("E_2_local_today"), d.get("E_2_user_today")
+		if local is not None and imported is not None:
+			d["Self_sufficiency"] = _ratio(local, local + imported)
+
+		charged, discharged = self.counters["Bat_E_charge"].last, self.counters["Bat_E_discharge"].last
+		if charged and discharged:
+			d["Bat_efficiency"] = _ratio(discharged[0], charged[0], 1) # lifetime
+		if "Bat_E_charge_today" in d and "Bat_E_discharge_today" in d:
+			d["Bat_efficiency_today"] = _ratio(d["Bat_E_discharge_today"], d["Bat_E_charge_today"], 0.5)
+
+		# DC coupled battery: PV = AC out - battery discharge + battery charge (+ losses)
+		pv = d.get("PV_E_today_int")
+		if pv is not None and all(k in d for k in ("AC_E_today_int", "Bat_E_charge_today_int", "Bat_E_discharge_today_int")):
+			out = d["AC_E_today_int"] + d["Bat_E_charge_today_int"] - d["Bat_E_discharge_today_int"]
+			d["PV_AC_efficiency_today"] = _ratio(out, pv, 0.1)
+
+		return {k: v for k, v in d.items() if v is not None}
+
+	# ----------------------------------------------------------------------------------
+	def save(self, path):
+		state = {
+			"day": self.day,
+			"counters": {k: [c.last, c.today] for k, c in self.counters.items()},
+			"integrals": {k: [i.last, i.today] for k, i in self.integrals.items()},
+		}
+		tmp = f"{path}.tmp"	# a crash while writing keeps the previous state
+		with open(tmp, "w") as f:
+			json.dump(state, f)
+		os.replace(tmp, path)
+
+	def load(self, path):
+		"""restore the daily values saved today, returns True if restored"""
+		try:
+			with open(path) as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			return False
+
+		if state.get("day") != time.strftime("%Y-%m-%d"):
+			return False
+
+		self.day = state["day"]
+		for group, items in (("counters", self.counters), ("integrals", self.integrals)):
+			for k, (last, today) in state.get(group, {}).items():
+				if k in items:
+					items[k].last = tuple(last) if last else None
+					items[k].today = today
+		return True
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Poll several units sharing one bus (e.g. daisy-chained SPH on one RS485 line).
+#
+#   inv1 = growatt.SPH(device=RS485Port, parity="N", unit=1)
+#   inv2 = growatt.SPH(parent=inv1, unit=2)
+#
+#   fleet = Fleet()
+#   fleet.add(inv1, ["PV_P", "AC_P"], interval=1, priority=0, callback=publish)
+#   fleet.add(inv2, ["PV_P", "AC_P"], interval=1, priority=0, callback=publish)
+#   fleet.run()
+#
+# The scheduler executes one batch request at a time: among all due jobs the
+# one with the best (lowest) priority, then the earliest due time, goes next.
+# So units interleave on the bus instead of waiting for whole cycles of the
+# others. Every request holds the bus lock of the units, writes from other
+# threads (e.g. MQTT) are serialized with the polling and go first (arbiter.py).
+
+import time
+import logging
+import threading
+
+import ModBusDev as MBD
+
+
+class Job:
+	def __init__(self, dev, items, interval, priority, callback):
+		self.dev = dev
+		self.items = frozenset(items)
+		self.interval = interval
+		self.priority = priority
+		self.callback = callback
+
+		self.due = time.monotonic()
+		self.pending = []		# batches left in the current cycle
+		self.results = {}
+		self.started = None
+
+		self.cycles = 0
+		self.cycletime = None	# s, bus time of the last complete cycle
+		self.cycletime_avg = None
+		self.last = None		# monotonic timestamp of the last complete cycle
+
+	def start_cycle(self):
+		# cached holding registers are not read again, like read_list()
+		self.results, items = self.dev._cache_lookup(self.items)
+		self.pending = [(plan, rtype) for rtype in MBD.registerType for plan in self.dev._plan(items, rtype)]
+		self.started = time.monotonic()
+
+	def step(self):
+		"""run the next batch of this job, returns True when the cycle is complete"""
+		if not self.pending:
+			self.start_cycle()
+			if not self.pending: # nothing to read: all cached or no known keys
+				return True
+
+		plan, rtype = self.pending.pop(0)
+		self.results.update(self.dev._read_compiled(plan, rtype))
+
+		return not self.pending
+
+
+class Fleet:
+	def __init__(self):
+		self.jobs = []
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.started = time.monotonic()
+
+	def add(self, dev, items, interval, priority=0, callback=None):
+		"""poll `items` of `dev` every `interval` s, callback(dev, results) per cycle"""
+		job = Job(dev, items, interval, priority, callback)
+		with self.lock:
+			self.jobs.append(job)
+		return job
+
+	def remove(self, job):
+		with self.lock:
+			self.jobs.remove(job)
+
+	def _next(self, now):
+		due = [j for j in self.jobs if j.due <= now]
+		if due:
+			return min(due, key=lambda j: (j.priority, j.due)), 0
+
+		if not self.jobs:
+			return None, 1
+		return None, min(j.due for j in self.jobs) - now
+
+	def run_once(self):
+		"""run at most one batch request, returns the time to wait until the next one"""
+		now = time.monotonic()
+
+		with self.lock:
+			job, wait = self._next(now)
+
+		if not job:
+			return wait
+
+		if job.step():
+			done = time.monotonic()
+			job.cycletime = done - job.started
+			job.cycletime_avg = job.cycletime if job.cycletime_avg is None else 0.9 * job.cycletime_avg + 0.1 * job.cycletime
+			job.cycles += 1
+			job.last = done
+
+			# schedule on the grid of the job, skip missed slots
+			job.due += job.interval
+			if job.due < done:
+				job.due = done + job.interval - (done - job.due) % job.interval
+
+			if job.callback:
+				try:
+					job.callback(job.dev, job.dev._clean_data(job.results))
+				except Exception as e:
+					logging.error(f"fleet callback for {job.dev}: {e}")
+
+		return 0
+
+	def run(self):
+		while not self.stopped.is_set():
+			wait = self.run_once()
+			if wait > 0:
+				self.stopped.wait(wait)
+
+	def stop(self):
+		self.stopped.set()
+
+	def stats(self):
+		"""per unit cycle time (last and average, s), completed cycles and cycles/s"""
+		elapsed = time.monotonic() - self.started
+		with self.lock:
+			return [
+				{
+					"unit": j.dev.unit,
+					"model": j.dev.model,
+					"cycles": j.cycles,
+					"rate": j.cycles / elapsed if elapsed > 0 else 0,
+					"cycletime": j.cycletime,
+					"cycletime_avg": j.cycletime_avg,
+					"interval": j.interval,
+					"priority": j.priority,
+				}
+				for j in self.jobs
+			]
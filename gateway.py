@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Modbus TCP gateway: any number of TCP clients (home automation, dashboards,
+# other monitoring) read the inverter without a bus transaction of their own.
+#
+# Reads (function 3 / 4) are answered from the register image of the input
+# and holding ranges of the device, kept up to date by every read of the
+# owner (poller included, see readrpc.ReadCoalescer.listen()). Registers older
+# than `max_age` s are read once for all clients asking at that time (DEMAND
+# priority). Writes (function 6 / 16) are forwarded one at a time in arrival
+# order with CONTROL priority, answered after the inverter acknowledged them
+# and put into the image, so a client reads back what it wrote.
+#
+#   rpc = readrpc.ReadCoalescer(inv, reply=None)
+#   gw = Gateway(inv, rpc, port=5502, max_age=5, writable={"Active_P_Rate"})
+#
+# Modbus TCP has no authentication: the gateway listens on 127.0.0.1 unless
+# another `host` is given ("0.0.0.0": every interface, any host of the network
+# may then write the `writable` registers).
+#   ...
+#   gw.close()
+#
+# Exceptions: 1 unsupported function, 2 address not covered by the register map
+# (or not writable, or a write not covering whole registers), 3 invalid count, 4 write failed, 11 no answer from the inverter
+
+import queue
+import struct
+import logging
+import threading
+import socketserver
+
+import ModBusDev as MBD
+import readrpc
+
+MBAP = struct.Struct(">HHHB")	# transaction id, protocol id, length, unit
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+DEVICE_FAILURE = 4
+NO_RESPONSE = 11
+
+READS = {3: MBD.registerType.HOLDING, 4: MBD.registerType.INPUT}
+
+
+class _Handler(socketserver.BaseRequestHandler):
+	def _recv(self, n):
+		data = b""
+		while len(data) < n:
+			chunk = self.request.recv(n - len(data))
+			if not chunk:
+				return None
+			data += chunk
+		return data
+
+	def handle(self):
+		gw = self.server.gateway
+		while True:
+			header = self._recv(MBAP.size)
+			if header is None:
+				return
+			tid, pid, length, unit = MBAP.unpack(header)
+			pdu = self._recv(length - 1)
+			if not pdu:
+				return
+
+			if unit not in (gw.dev.unit, 0, 0xFF):
+				continue # not ours, like a serial device that doesn't answer
+			try:
+				reply = gw.handle(pdu)
+			except Exception as e:
+				logging.error(f"gateway request {pdu.hex()}: {e}")
+				reply = struct.pack(">BB", pdu[0] | 0x80, DEVICE_FAILURE)
+			self.request.sendall(MBAP.pack(tid, pid, len(reply) + 1, unit) + reply)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class Gateway:
+	"""serves `dev` on Modbus TCP, `writable`: keys that may be written (None: dev.writable)"""
+
+	def __init__(self, dev, rpc=None, host="127.0.0.1", port=502, max_age=5, writable=None, timeout=30):
+		self.dev = dev
+		self.rpc = rpc or readrpc.ReadCoalescer(dev, reply=None)
+		self.max_age = max_age
+		self.writable = set(dev.writable if writable is None else writable)
+		self.timeout = timeout
+
+		# addresses the batch plans of all registers read: the image of the device
+		self.covered = {rtype: set() for rtype in MBD.registerType}
+		for rtype in MBD.registerType:
+			for plan in dev._plan(None, rtype):
+				self.covered[rtype].update(range(plan[0], plan[0] + plan[1]))
+
+		self.rpc.listen()
+		self.writes = queue.Queue()
+		threading.Thread(target=self._writer, daemon=True).start()
+
+		self.server = _Server((host, port), _Handler)
+		self.server.gateway = self
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	@property
+	def port(self):
+		return self.server.server_address[1]
+
+	def handle(self, pdu):
+		"""response PDU of a request PDU"""
+		fc = pdu[0]
+
+		if fc in READS and len(pdu) == 5:
+			address, count = struct.unpack(">HH", pdu[1:])
+			if not 1 <= count <= 125:
+				return struct.pack(">BB", fc | 0x80, ILLEGAL_VALUE)
+			return self._read(fc, READS[fc], address, count)
+
+		if fc == 6 and len(pdu) == 5:
+			address, value = struct.unpack(">HH", pdu[1:])
+			return self._write(fc, address, [value]) or pdu
+
+		if fc == 16 and len(pdu) >= 6:
+			address, count, n = struct.unpack(">HHB", pdu[1:6])
+			if not 1 <= count <= 123 or n != 2 * count or len(pdu) != 6 + n:
+				return struct.pack(">BB", fc | 0x80, ILLEGAL_VALUE)
+			values = list(struct.unpack(f">{count}H", pdu[6:]))
+			return self._write(fc, address, values) or struct.pack(">BHH", fc, address, count)
+
+		return struct.pack(">BB", fc | 0x80, ILLEGAL_FUNCTION)
+
+	def _read(self, fc, rtype, address, count):
+		if not self.covered[rtype].issuperset(range(address, address + count)):
+			return struct.pack(">BB", fc | 0x80, ILLEGAL_ADDRESS)
+
+		registers = self.rpc.cached(rtype, address, count, self.max_age)
+		if registers is not None: # no need to wait for the coalescing window
+			return struct.pack(f">BB{count}H", fc, 2 * count, *registers)
+
+		try:
+			ans = self.rpc.call({"ranges": [{"rtype": rtype.name, "address": address, "count": count}], "max_age": self.max_age}, self.timeout)
+		except TimeoutError:
+			ans = {}
+		if not ans.get("ranges"):
+			return struct.pack(">BB", fc | 0x80, NO_RESPONSE)
+
+		return struct.pack(f">BB{count}H", fc, 2 * count, *ans["ranges"][0]["registers"])
+
+	def _write(self, fc, address, values):
+		"""None if written, else the exception response"""
+		end = address + len(values)
+		keys = self.dev.registers.overlapping(MBD.registerType.HOLDING, address, len(values))
+		covered = sum(self.dev.registers[k].length for k in keys)
+
+		for k in keys:
+			r = self.dev.registers[k]
+			if k not in self.writable or r.address < address or r.address + r.length > end:
+				return struct.pack(">BB", fc | 0x80, ILLEGAL_ADDRESS) # e.g. one word of a 32 bit register
+		if covered != len(values):
+			return struct.pack(">BB", fc | 0x80, ILLEGAL_ADDRESS) # gaps between the registers
+
+		done = threading.Event()
+		result = []
+		self.writes.put((address, values, result, done))
+		if not done.wait(self.timeout):
+			return struct.pack(">BB", fc | 0x80, NO_RESPONSE)
+		return None if result[0] else struct.pack(">BB", fc | 0x80, DEVICE_FAILURE)
+
+	def _writer(self):
+		"""the writes of all clients in arrival order, one at a time"""
+		while True:
+			address, values, result, done = self.writes.get()
+			ok = False
+			try:
+				r = self.dev._write_holding_register(address, values)
+				ok = r is not None and not r.isError()
+				if ok:
+					self.rpc._store_raw(MBD.registerType.HOLDING, address, values)
+			except Exception as e:
+				logging.error(f"gateway write {address}: {e}")
+			result.append(ok)
+			done.set()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Transaction metrics of a ModBusDev (dev.metrics).
+#
+#   dev.metrics.snapshot()                      # dict, e.g. for MQTT
+#   dev.metrics.write_prometheus("/var/lib/node_exporter/growatt.prom")
+
+import os
+import time
+import threading
+
+# request latency histogram buckets in s
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float("inf"))
+
+OUTCOMES = ("ok", "timeout", "invalid", "short")
+
+
+class Metrics:
+	def __init__(self, labels=None):
+		self.labels = labels or {}
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.started = time.time()
+			self.requests = {}		# (rtype, outcome): count
+			self.buckets = {}		# rtype: [count per bucket]
+			self.seconds = {}		# rtype: summed request time
+			self.registers = {}		# rtype: registers received
+			self.bytes = 0			# estimated bytes on the wire
+			self.retries = 0
+			self.reconnects = 0
+			self.decode_errors = 0
+			self.cycles = 0
+			self.cycle = None		# last cycle: {"seconds": s, "batches": [...]}
+			self.waits = {}			# bus priority: [count, summed, max wait for the bus]
+			self.commands = {"count": 0, "failed": 0, "last": None, "max": 0.0, "sum": 0.0}
+
+	def request(self, rtype, seconds, outcome, registers=0, overhead=0):
+		"""account one request / response attempt"""
+		with self.lock:
+			key = (rtype, outcome)
+			self.requests[key] = self.requests.get(key, 0) + 1
+
+			buckets = self.buckets.setdefault(rtype, [0] * len(BUCKETS))
+			for i, b in enumerate(BUCKETS):
+				if seconds <= b:
+					buckets[i] += 1
+					break
+
+			self.seconds[rtype] = self.seconds.get(rtype, 0.0) + seconds
+			self.registers[rtype] = self.registers.get(rtype, 0) + registers
+			self.bytes += overhead + 2 * registers
+
+	def retry(self):
+		with self.lock:
+			self.retries += 1
+
+	def reconnect(self):
+		with self.lock:
+			self.reconnects += 1
+
+	def decode_error(self):
+		with self.lock:
+			self.decode_errors += 1
+
+	def bus_wait(self, priority, seconds):
+		"""time a request waited for the bus (see arbiter.py)"""
+		with self.lock:
+			w = self.waits.setdefault(priority, [0, 0.0, 0.0])
+			w[0] += 1
+			w[1] += seconds
+			w[2] = max(w[2], seconds)
+
+	def command(self, seconds, ok):
+		"""command to ack latency of a write"""
+		with self.lock:
+			c = self.commands
+			c["count"] += 1
+			c["failed"] += not ok
+			c["last"] = seconds
+			c["max"] = max(c["max"], seconds)
+			c["sum"] += seconds
+
+	def cycle_done(self, seconds, batches):
+		"""batches: [(rtype, address, length, seconds), ...] of one read_list / read_all"""
+		with self.lock:
+			self.cycles += 1
+			self.cycle = {
+				"seconds": seconds,
+				"batches": [{"rtype": r, "address": a, "length": l, "seconds": s} for r, a, l, s in batches],
+			}
+
+	# ------------------------------------------------------------------------------
+	def snapshot(self):
+		with self.lock:
+			rtypes = sorted(self.buckets)
+			return {
+				**self.labels,
+				"uptime": time.time() - self.started,
+				"requests": {r: {o: self.requests.get((r, o), 0) for o in OUTCOMES} for r in rtypes},
+				"latency": {
+					r: {
+						"buckets": dict(zip(["+Inf" if b == float("inf") else b for b in BUCKETS], self.buckets[r])),
+						"sum": self.seconds[r],
+						"count": sum(self.buckets[r]),
+					}
+					for r in rtypes
+				},
+				"registers": dict(self.registers),
+				"bytes": self.bytes,
+				"retries": self.retries,
+				"timeouts": sum(v for (r, o), v in self.requests.items() if o == "timeout"),
+				"short": sum(v for (r, o), v in self.requests.items() if o == "short"),
+				"invalid": sum(v for (r, o), v in self.requests.items() if o == "invalid"),
+				"reconnects": self.reconnects,
+				"decode_errors": self.decode_errors,
+				"cycles": self.cycles,
+				"cycle": self.cycle,
+				"bus_wait": {p: {"count": n, "sum": s, "max": m} for p, (n, s, m) in self.waits.items()},
+				"commands": dict(self.commands),
+			}
+
+	def prometheus(self, prefix="modbus"):
+		"""metrics in the prometheus text exposition format"""
+		s = self.snapshot()
+		base = ",".join(f'{k}="{v}"' for k, v in self.labels.items())
+		lbl = lambda **kw: "{" + ",".join(filter(None, [base] + [f'{k}="{v}"' for k, v in kw.items()])) + "}"
+
+		out = [f"# TYPE {prefix}_requests_total counter"]
+		for r, outcomes in s["requests"].items():
+			for o, v in outcomes.items():
+				out.append(f"{prefix}_requests_total{lbl(rtype=r, outcome=o)} {v}")
+
+		out.append(f"# TYPE {prefix}_request_seconds histogram")
+		for r, h in s["latency"].items():
+			acc = 0
+			for b, v in h["buckets"].items():
+				acc += v
+				out.append(f"{prefix}_request_seconds_bucket{lbl(rtype=r, le=b)} {acc}")
+			out.append(f"{prefix}_request_seconds_sum{lbl(rtype=r)} {h['sum']}")
+			out.append(f"{prefix}_request_seconds_count{lbl(rtype=r)} {h['count']}")
+
+		out.append(f"# TYPE {prefix}_registers_total counter")
+		for r, v in s["registers"].items():
+			out.append(f"{prefix}_registers_total{lbl(rtype=r)} {v}")
+
+		for name in ("bytes", "retries", "reconnects", "decode_errors", "cycles"):
+			out.append(f"# TYPE {prefix}_{name}_total counter")
+			out.append(f"{prefix}_{name}_total{lbl()} {s[name]}")
+
+		out.append(f"# TYPE {prefix}_bus_wait_seconds summary")
+		for p, w in s["bus_wait"].items():
+			out.append(f"{prefix}_bus_wait_seconds_sum{lbl(priority=p)} {w['sum']}")
+			out.append(f"{prefix}_bus_wait_seconds_count{lbl(priority=p)} {w['count']}")
+
+		out.append(f"# TYPE {prefix}_command_seconds summary")
+		out.append(f"{prefix}_command_seconds_sum{lbl()} {s['commands']['sum']}")
+		out.append(f"{prefix}_command_seconds_count{lbl()} {s['commands']['count']}")
+		out.append(f"# TYPE {prefix}_command_seconds_max gauge")
+		out.append(f"{prefix}_command_seconds_max{lbl()} {s['commands']['max']}")
+
+		if s["cycle"]:
+			out.append(f"# TYPE {prefix}_cycle_seconds gauge")
+			out.append(f"{prefix}_cycle_seconds{lbl()} {s['cycle']['seconds']}")
+			out.append(f"# TYPE {prefix}_batch_seconds gauge")
+			for b in s["cycle"]["batches"]:
+				out.append(f"{prefix}_batch_seconds{lbl(rtype=b['rtype'], address=b['address'], length=b['length'])} {b['seconds']}")
+
+		return "\n".join(out) + "\n"
+
+	def write_prometheus(self, path, prefix="modbus"):
+		"""write a node_exporter textfile (atomically)"""
+		tmp = f"{path}.tmp"
+		with open(tmp, "w") as f:
+			f.write(self.prometheus(prefix))
+		os.replace(tmp, path)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Buffered MQTT publishing, decoupled from the Modbus polling.
+#
+# publish() only queues the message (bounded queue, never blocks), a publisher
+# thread hands batches to the paho client. While the broker is unreachable the
+# messages go to a spool file (json lines), after reconnecting the spool is
+# drained at `rate` messages/s before new messages are sent, so the order is kept.
+# The read offset of the spool is kept in <spool>.pos, so a restart continues
+# where it stopped. Messages with QoS >= 1 that paho accepted while the
+# connection dropped stay with paho (it sends them after reconnecting) and are
+# not spooled again.
+#
+#   pub = BufferedPublisher(spool="pv2mqtt_spool.jsonl", qos=1)
+#   pub.client = mq1            # paho client, may be set / connect later
+#   pub.publish("pv2/data", json.dumps(data))
+#   pub.stats()                 # queue depth, spooled, dropped, publish latency
+
+import os
+import json
+import base64
+import time
+import queue
+import logging
+import threading
+
+MQTT_ERR_NO_CONN = 4		# paho.mqtt.client, QoS >= 1 messages are kept in paho's queue
+
+
+class BufferedPublisher:
+	def __init__(self, client=None, maxqueue=1000, spool=None, spoolmax=50e6, qos=0, rate=20, batch=50):
+		self.client = client
+		self.queue = queue.Queue(maxqueue)
+		self.spool = spool
+		self.spoolmax = spoolmax
+		self.qos = qos
+		self.rate = rate
+		self.batch = batch
+
+		self.lock = threading.Lock()
+		self.spoolpos = self._load_pos()	# read offset of the spool file
+		self.published = 0
+		self.dropped = 0
+		self.latency = None			# s, smoothed queue -> broker handover
+		self.latency_max = 0.0
+
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def publish(self, topic, payload, qos=None, retain=False):
+		"""queue a message, returns False if it had to be dropped"""
+		msg = (topic, payload, self.qos if qos is None else qos, retain, time.time())
+		try:
+			self.queue.put_nowait(msg)
+		except queue.Full:
+			with self.lock:
+				self.dropped += 1
+			return False
+		return True
+
+	def connected(self):
+		return self.client is not None and self.client.is_connected()
+
+	def spooled(self):
+		"""bytes waiting in the spool file"""
+		if not self.spool or not os.path.exists(self.spool):
+			return 0
+		return max(0, os.path.getsize(self.spool) - self.spoolpos)
+
+	def stats(self):
+		with self.lock:
+			return {
+				"queue": self.queue.qsize(),
+				"spool_bytes": self.spooled(),
+				"published": self.published,
+				"dropped": self.dropped,
+				"latency": self.latency,
+				"latency_max": self.latency_max,
+				"connected": self.connected(),
+			}
+
+	def stop(self, timeout=5):
+		self.stopped.set()
+		self.thread.join(timeout)
+
+	# ----------------------------------------------------------------------------------
+	def _get_batch(self):
+		try:
+			msgs = [self.queue.get(timeout=1)]
+		except queue.Empty:
+			return []
+
+		while len(msgs) < self.batch:
+			try:
+				msgs.append(self.queue.get_nowait())
+			except queue.Empty:
+				break
+
+		# of retained messages only the last one per topic matters
+		last = {m[0]: i for i, m in enumerate(msgs) if m[3]}
+		return [m for i, m in enumerate(msgs) if not m[3] or last[m[0]] == i]
+
+	def _send(self, msg):
+		"""hand a message to paho, False if it has to be spooled"""
+		topic, payload, qos, retain, queued = msg
+		info = self.client.publish(topic, payload, qos=qos, retain=retain)
+		if info.rc == MQTT_ERR_NO_CONN and qos > 0:
+			return True # queued by paho, sent after reconnecting
+		if info.rc != 0:
+			return False
+
+		latency = time.time() - queued
+		with self.lock:
+			self.published += 1
+			self.latency = latency if self.latency is None else self.latency + (latency - self.latency) / 8
+			self.latency_max = max(self.latency_max, latency)
+		return True
+
+	def _spool_write(self, msgs):
+		if not self.spool:
+			with self.lock:
+				self.dropped += len(msgs)
+			return
+
+		if self.spooled() > self.spoolmax:
+			with self.lock:
+				self.dropped += len(msgs)
+			return
+
+		try:
+			with open(self.spool, "a") as f:
+				for topic, payload, *m in msgs:
+					if isinstance(payload, bytes): # binary payloads as {"b64": ...}
+						payload = {"b64": base64.b64encode(payload).decode()}
+					f.write(json.dumps([topic, payload, *m]) + "\n")
+		except OSError as e:
+			logging.error(f"Error writing {self.spool}: {e}")
+			with self.lock:
+				self.dropped += len(msgs)
+
+	def _load_pos(self):
+		"""read offset saved by a previous run, 0 if it doesn't fit the spool"""
+		if not self.spool or not os.path.exists(self.spool):
+			return 0
+		try:
+			with open(f"{self.spool}.pos") as f:
+				pos = int(f.read())
+		except (OSError, ValueError):
+			return 0
+		return pos if 0 <= pos <= os.path.getsize(self.spool) else 0
+
+	def _save_pos(self):
+		try:
+			with open(f"{self.spool}.pos", "w") as f:
+				f.write(str(self.spoolpos))
+		except OSError as e:
+			logging.error(f"Error writing {self.spool}.pos: {e}")
+
+	def _spool_remove(self):
+		self.spoolpos = 0
+		for path in (self.spool, f"{self.spool}.pos"):
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+
+	def _spool_drain(self):
+		"""send up to `rate` spooled messages, True if the spool is empty"""
+		start = self.spoolpos
+		try:
+			with open(self.spool) as f:
+				f.seek(self.spoolpos)
+				for i in range(self.rate):
+					line = f.readline()
+					if not line:
+						break
+					msg = json.loads(line)
+					if isinstance(msg[1], dict):
+						msg[1] = base64.b64decode(msg[1]["b64"])
+					if not self._send(msg):
+						break
+					self.spoolpos = f.tell()
+		except FileNotFoundError:
+			self._spool_remove()
+			return True
+		except (OSError, ValueError) as e:
+			logging.error(f"Error reading {self.spool}: {e}, discarding it")
+			self._spool_remove()
+			return True
+
+		if self.spooled() == 0:
+			self._spool_remove()
+			return True
+		if self.spoolpos != start:
+			self._save_pos()
+		return False
+
+	def run(self):
+		drained = 0
+		while not self.stopped.is_set():
+			backlog = self.spooled() > 0
+
+			# one drain step per second, _get_batch() waits at most 1 s
+			if backlog and self.connected() and time.monotonic() - drained >= 1:
+				drained = time.monotonic()
+				backlog = not self._spool_drain()
+
+			msgs = self._get_batch()
+			if not msgs:
+				continue
+
+			if backlog or not self.connected():
+				self._spool_write(msgs)
+				continue
+
+			for i, m in enumerate(msgs):
+				if not self._send(m):
+					self._spool_write(msgs[i:])
+					break
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Encodings of the data payload (pv2mqtt <topic>/data).
+#
+#   "json"      {"AC_P":351.6,"Bat_SOC":50,...}, like json.dumps but formatted by a
+#               template precomputed per key set, decimals from the register scaling
+#   "array"     [schema id, time, value, ...] as compact json
+#   "msgpack"   the same list as MessagePack (optional: pip install msgpack)
+#   "cbor"      the same list as CBOR (optional: pip install cbor2)
+#   "binary"    >HI schema id, time, then the numeric values as scaled integers in
+#               the register data type (float32 for keys that are no registers),
+#               then >H length + json array of the other (text, enum) values
+#
+# The schema (key order, units, binary layout) of the list and binary
+# encodings is returned by encode() the first time it is used, publish it
+# retained (pv2mqtt: <topic>/schema/<id>) so receivers can decode the frames.
+#
+#   enc = Encoder(inv.registers, "binary", units=derived.UNITS)
+#   frame, schema = enc.encode(values)
+#   if schema:
+#       publish(f"pv2/schema/{schema['id']}", json.dumps(schema), retain=True)
+
+import json
+import math
+import time
+import zlib
+import struct
+
+import ModBusDev as MBD
+
+ENCODINGS = ("json", "array", "msgpack", "cbor", "binary")
+
+dt = MBD.registerDataType
+
+# struct code per register data type, other types and keys that are no registers: "f"
+BINARY = {dt.UINT8: "H", dt.UINT16: "H", dt.UINT32: "I", dt.INT8: "h", dt.INT16: "h", dt.INT32: "i"}
+
+# range of a struct code, values outside are sent as the missing value (first of the range
+# for signed, last for unsigned codes)
+LIMITS = {"H": (0, 0xFFFE), "I": (0, 0xFFFFFFFE), "h": (-0x7FFF, 0x7FFF), "i": (-0x7FFFFFFF, 0x7FFFFFFF)}
+MISSING = {"H": 0xFFFF, "I": 0xFFFFFFFF, "h": -0x8000, "i": -0x80000000}
+
+
+def _decimals(sf):
+	"""decimals needed for a value scaled by sf (0.1: 1)"""
+	if sf >= 1:
+		return 0
+	return min(3, math.ceil(-math.log10(sf) - 1e-9))
+
+
+class Layout:
+	"""encoding of one set of keys"""
+
+	def __init__(self, encoder, keys):
+		registers, units = encoder.registers, encoder.units
+		self.keys = sorted(keys)
+		self.numeric = []		# keys encoded as numbers
+		self.other = []			# keys encoded as json values
+		self.decimals = {}
+
+		for k in self.keys:
+			r = registers.get(k)
+			if r is not None and r.vtype in (int, float) and isinstance(r.fmt, str):
+				self.numeric.append(k)
+				self.decimals[k] = _decimals(r.sf) if r.vtype is float or r.sf < 1 else 0
+			elif r is None and k in units:
+				self.numeric.append(k)
+				self.decimals[k] = 3
+			else:
+				self.other.append(k)
+
+		# json: one format string for the whole object
+		parts = []
+		for k in self.keys:
+			spec = f"%.{self.decimals[k]}f" if k in self.decimals else "%s"
+			parts.append(f"{json.dumps(k)}:{spec}")
+		self.template = "{" + ",".join(parts) + "}"
+
+		# binary: numeric part of the frame
+		self.codes = []
+		self.scales = []
+		for k in self.numeric:
+			r = registers.get(k)
+			code = BINARY.get(r.dtype, "f") if r is not None else "f"
+			self.codes.append(code)
+			self.scales.append(1 / r.sf if code != "f" else None)
+		self.struct = struct.Struct(">HI" + "".join(self.codes))
+
+		self.schema = {
+			"encoding": encoder.encoding,
+			"keys": self.numeric + self.other,
+			"units": {k: registers[k].fmt if k in registers else units.get(k) for k in self.numeric},
+		}
+		if encoder.encoding == "binary":
+			self.schema["format"] = self.struct.format
+			self.schema["scale"] = {k: registers[k].sf for k, s in zip(self.numeric, self.scales) if s}
+
+		self.id = zlib.crc32(json.dumps(self.schema, sort_keys=True).encode()) & 0xFFFF
+		self.schema["id"] = self.id
+
+	def row(self, values):
+		"""values in schema order, numbers rounded to their decimals"""
+		row = [round(values[k], self.decimals[k]) for k in self.numeric]
+		row += [values[k] for k in self.other]
+		return row
+
+	def binary(self, values, t):
+		raw = []
+		for k, code, scale in zip(self.numeric, self.codes, self.scales):
+			v = values[k]
+			if scale is None:
+				raw.append(v)
+				continue
+
+			v = round(v * scale)
+			lo, hi = LIMITS[code]
+			raw.append(v if lo <= v <= hi else MISSING[code])
+
+		tail = json.dumps([values[k] for k in self.other], separators=(",", ":")).encode() if self.other else b""
+		return self.struct.pack(self.id, int(t), *raw) + struct.pack(">H", len(tail)) + tail
+
+
+class Encoder:
+	def __init__(self, registers, encoding="json", units=None):
+		if encoding not in ENCODINGS:
+			raise ValueError(f"unknown encoding {encoding}, one of {ENCODINGS}")
+
+		self.registers = registers
+		self.encoding = encoding
+		self.units = units or {}
+		self.layouts = {}			# frozenset of keys: Layout
+		self.announced = set()		# schema ids returned by encode()
+
+		if encoding == "msgpack":
+			import msgpack
+			self.pack = msgpack.packb
+		elif encoding == "cbor":
+			import cbor2
+			self.pack = cbor2.dumps
+
+	def layout(self, keys):
+		keys = frozenset(keys)
+		layout = self.layouts.get(keys)
+		if layout is None:
+			layout = self.layouts[keys] = Layout(self, keys)
+		return layout
+
+	def value(self, key, v):
+		"""json of a single value, rounded like in the payload"""
+		layout = self.layout((key,))
+		return json.dumps(layout.row({key: v})[0])
+
+	def encode(self, values, t=None):
+		"""(payload, schema): schema of the payload if it is new, else None"""
+		layout = self.layout(values)
+		t = time.time() if t is None else t
+
+		if self.encoding == "json":
+			try:
+				args = tuple(values[k] if k in layout.decimals else json.dumps(values[k]) for k in layout.keys)
+				return layout.template % args, None
+			except TypeError: # e.g. a text in a numeric register
+				return json.dumps(values, separators=(",", ":")), None
+
+		if self.encoding == "binary":
+			payload = layout.binary(values, t)
+		else:
+			row = [layout.id, int(t)] + layout.row(values)
+			payload = json.dumps(row, separators=(",", ":")) if self.encoding == "array" else self.pack(row)
+
+		if layout.id in self.announced:
+			return payload, None
+		self.announced.add(layout.id)
+		return payload, layout.schema
+
+
+def decode_binary(frame, schema):
+	"""{key: value} of a binary frame, the counterpart of Encoder(..., "binary")"""
+	fixed = struct.Struct(schema["format"])
+	values = fixed.unpack_from(frame)
+	if values[0] != schema["id"]:
+		raise ValueError(f"frame of schema {values[0]}, not {schema['id']}")
+
+	numeric = [k for k in schema["keys"] if k in schema["units"]]
+	codes = fixed.format[3:]
+	result = {"time": values[1]}
+	for k, code, v in zip(numeric, codes, values[2:]):
+		if v == MISSING.get(code) or v != v: # NaN
+			result[k] = None
+		else:
+			sf = schema["scale"].get(k)
+			result[k] = v * sf if sf else v
+
+	n, = struct.unpack_from(">H", frame, fixed.size)
+	if n:
+		other = [k for k in schema["keys"] if k not in schema["units"]]
+		result.update(zip(other, json.loads(frame[fixed.size + 2:fixed.size + 2 + n])))
+	return result
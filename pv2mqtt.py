@@ -6,7 +6,7 @@ import time
 import logging
 import logging.handlers as Handlers
 import argparse
-from threading import Thread, Lock
+from threading import Thread
 
 
 parser = argparse.ArgumentParser()
@@ -14,6 +14,10 @@ loggroup = parser.add_mutually_exclusive_group(required=False)
 loggroup.add_argument("-q", "--quiet",   action="store_const", dest="loglevel", const=logging.ERROR, help="only error output", default=logging.WARNING)
 loggroup.add_argument("-v", "--verbose", action="store_const", dest="loglevel", const=logging.INFO,  help="increase output verbosity")
 loggroup.add_argument("-d", "--debug",   action="store_const", dest="loglevel", const=logging.DEBUG, help="debug output")
+parser.add_argument("-p", "--port", help="RS485 device of the inverter (e.g. the pty of simulator.py)")
+parser.add_argument("--record", metavar="FILE", help="capture all inverter responses to FILE")
+parser.add_argument("--replay", metavar="FILE", help="read from a capture instead of the inverter")
+parser.add_argument("--speed", type=float, help="replay speed factor (default: as fast as possible)")
 
 args = parser.parse_args()
 
@@ -32,6 +36,7 @@ log.addHandler(ConsoleLogHandler)
 # =========================================================================================
 # =========================================================================================
 
+import os
 import math
 import datetime
 import json
@@ -49,17 +54,100 @@ MQTT_Settings = {
 	
 mqttpvtopic = MQTT_Settings['PV_Topic']
 
+# poll interval overrides in s, defaults see growatt.SPH.pollintervals
+Poll_Intervals = {
+	}
+
+# only publish values that moved at least their deadband (by key or unit),
+# everything is republished at least every `Heartbeat` s
+Deadbands = {
+	"W":	5,
+	"V":	0.1,
+	"A":	0.1,
+	"Hz":	0.02,
+	"kWh":	0.1,
+	"%":	1,
+	"°C":	1,
+	}
+Relative_Deadbands = {
+	}
+Heartbeat = 300
+
+# publish every changed value on <topic>/<key> (retained) instead of one <topic>/data
+Per_Field_Topics = False
+
+# encoding of <topic>/data: "json", "array", "msgpack", "cbor" or "binary" (see payload.py),
+# all but json are lists / frames described by the retained <topic>/schema/<id>
+Payload_Encoding = "json"
+
+# Modbus transaction metrics on <topic>/metrics every `Metrics_Interval` s,
+# optionally also as node_exporter textfile
+Metrics_Interval = 60
+Prometheus_File = None
+
+# persisted identity registers (serial number, firmware, ...)
+Cache_File = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pv2mqtt_cache.json")
+
+# local history of all numeric values (raw 5 s, 1 min and 15 min means), see tsstore.py,
+# written to the card every `Store_Flush` s (None: off)
+Store_File = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pv2mqtt_store.ts")
+Store_Flush = 300
+
+# daily energies, self consumption, battery and conversion efficiency from every poll,
+# published with the data, state kept in `Derived_File` over a restart (see derived.py)
+Derived_File = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pv2mqtt_derived.json")
+
+# messages are queued and sent by a publisher thread, spooled to `Spool_File`
+# while the broker is unreachable and sent at `Spool_Rate` msg/s after reconnecting
+MQTT_QoS = 1
+Queue_Size = 1000
+Spool_File = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pv2mqtt_spool.jsonl")
+Spool_Rate = 20
+
+# holding registers settable on <topic>/<key>/set, <topic>/set, the bus socket and the
+# gateway, None: growatt.SPH.writable (operating settings and battery profiles, no grid protection limits)
+Writable = None
+
+# pv2mqtt owns the bus: latest values for local tools in `Bus_Table`, reads and writes
+# on the UNIX socket `Bus_Socket` (reader.py --bus, regdump.py --bus, see busd.py), None: off
+Bus_Table = "/dev/shm/growatt.tbl"
+Bus_Socket = "/tmp/growatt.sock"
+
+# Modbus TCP gateway on `Gateway_Port` (e.g. 5502, None: off), registers up to
+# `Gateway_MaxAge` s old are served from the polled ones (see gateway.py)
+Gateway_Port = None
+Gateway_MaxAge = 5
+# no authentication: only local clients, "0.0.0.0" lets every host of the network read and write
+Gateway_Host = "127.0.0.1"
+
+# requests on <topic>/read arriving within `Read_Window` s are served by one batched read
+Read_Window = 0.05
+
 RS485PortInv = '/dev/serial/by-path/platform-3f980000.usb-usb-0:1.3:1.0-port0' # Inverter
 
+if args.port:
+	RS485PortInv = args.port
+
 #------------------
 threads = {}
-mqttlock = Lock()
 
 import growatt
+import scheduler
+import deadband
+import tsstore
+import mqttpub
+import readrpc
+import derived
+import payload
+import busd
+import gateway
 import ModBusDev as MBD
 
 #============================================================================
 
+pub = mqttpub.BufferedPublisher(maxqueue=Queue_Size, spool=Spool_File, qos=MQTT_QoS, rate=Spool_Rate)
+rpc = None
+
 
 def mqtt_listen():
 	global mq1
@@ -69,8 +157,9 @@ def mqtt_listen():
 		logging.info(f"MQTT connected with result code {rc}")
 
 		# Subscribe here!
-		client.subscribe(f"{mqttpvtopic}/Active_P_Rate/set")
-		client.subscribe(f"{mqttpvtopic}/read_raw/get")
+		client.subscribe(f"{mqttpvtopic}/set")
+		client.subscribe(f"{mqttpvtopic}/+/set")
+		client.subscribe(f"{mqttpvtopic}/read")
 
 	# ------------------------------------------------------------------------------
 	def mqtt_event(client, userdata, msg):
@@ -78,28 +167,29 @@ def mqtt_listen():
 
 		try:
 		
-			if msg.topic == f"{mqttpvtopic}/Active_P_Rate/set":
-				val = int(msg.payload.decode("utf-8"))
-				logging.info(f"setting Active_P_Rate to {val}%")
-				gw1.write("Active_P_Rate", val)
-				
-			# --------------------------
-			elif msg.topic == f"{mqttpvtopic}/read_raw/get":
-
-				d = json.loads(msg.payload.decode("utf-8"))
-				ans = {"q":d}
+			# <topic>/<key>/set: value (json), <topic>/set: {key: value, ...}
+			if msg.topic.endswith("/set"):
+				key = msg.topic[len(mqttpvtopic) + 1:-len("/set")]
+				val = json.loads(msg.payload.decode("utf-8"))
+				values = val if key == "" else {key: val}
 
-				rtype = getattr(MBD.registerType, d['rtype'])
-				dtype = getattr(MBD.registerDataType, d['dtype'])
-				vtype = int if d['vtype'] == "int" else str
+				for k in values:
+					if k not in writable:
+						raise KeyError(f"{k} is not a writable register")
 
-				x = d['addr'],d['count'],rtype, dtype, vtype,"read_raw","",1,1
-				ans['ans'] = gw1._read(x)
+				logging.info(f"setting {values}")
+				ans = gw1.write_many(values, verify=True)
 
 				logging.info(ans)
-				with mqttlock:
-					client.publish(f"{mqttpvtopic}/read_raw", json.dumps(ans))
-				client.loop()
+				pub.publish(f"{mqttpvtopic}/set/result", json.dumps(ans))
+
+			# --------------------------
+			# {"id": ..., "keys": [...], "ranges": [{"rtype", "address", "count"}], "max_age": s}, see readrpc.py
+			elif msg.topic == f"{mqttpvtopic}/read":
+				if rpc is None:
+					raise RuntimeError("inverter not connected yet")
+
+				rpc.submit(json.loads(msg.payload.decode("utf-8")))
 
 			# --------------------------
 			else:
@@ -115,9 +205,10 @@ def mqtt_listen():
 	mq1.will_set(f"{mqttpvtopic}/status", "Offline", qos=1, retain=False)
 	mq1.on_connect = mqtt_on_connect
 	mq1.on_message = mqtt_event
-	mq1.connect(MQTT_Settings['Server'], MQTT_Settings['Port'], 60)
+	mq1.connect_async(MQTT_Settings['Server'], MQTT_Settings['Port'], 60)
+	pub.client = mq1
 
-	mq1.loop_forever()  # Start networking daemon
+	mq1.loop_forever(retry_first_connection=True)  # Start networking daemon, reconnects
 
 # =====================================================================================
 # =====================================================================================
@@ -128,9 +219,7 @@ def mean(dataset):
 
 
 def sm_reader_work():
-	global mq1
-
-	list0  = ["Status", "PV_P", "AC_P"]
+	global gw1, writable, rpc
 
 	list1  = ["On_Off", "Status", "PV_P", "PV1_U", "PV1_I", "PV1_P", "PV2_U", "PV2_I", "PV2_P", "AC_P", "AC_F", "AC1_I", "AC2_I", "AC3_I", "Energy_total", "PV1_E_total", "PV2_E_total", "Temp", 
 	"DeratingMode", "FaultCode", "FaultBitcode", "FaultBitcode2", "WarningBit","Sys-Date", "Sys-Time"]
@@ -144,65 +233,142 @@ def sm_reader_work():
 		parity="N",
 		baud=9600,
 		timeout=1,
-		unit=1
+		unit=1,
+		cachefile=Cache_File,
+		capture=args.record,
+		replay=args.replay,
+		speed=args.speed
 		)
 
 
 	logging.info('Modbus Inverter connected')
 
-	sleep1 = 0.2
-	lastrun = datetime.datetime.now()
+	# registers that can be set via MQTT, the bus socket and the Modbus TCP gateway
+	writable = set(Writable if Writable is not None else gw1.writable)
 
-	while True:
-		
-#		try:
+	if gw1.load_cache():
+		logging.info(f"restored cached registers from {Cache_File}")
 
-			# only short round:
-			if (datetime.datetime.now() - lastrun).seconds < 5:
-				info = gw1.read_list(list0)
-#				print(info)
-
-				if info == {}: 
-					logging.warning(f"No data from inverter received")
-					time.sleep(sleep1)
-					continue
-
-			else:
+	logging.info(f"registers per request: {gw1.probe_limits()}")
 
-				lastrun = datetime.datetime.now()
+	rpc = readrpc.ReadCoalescer(gw1, lambda req, ans: pub.publish(f"{mqttpvtopic}/read/result", json.dumps(ans)), Read_Window)
 
-				info  = gw1.read_list(list1)
-				
-				if info == {}: # no info:
-					logging.warning(f"No data from inverter received")
-					with mqttlock:
-						mq1.publish(f"{mqttpvtopic}/status", "Offline")
+	table = busd.SnapshotTable(Bus_Table, writer=True) if Bus_Table else None
+	if Bus_Socket:
+		busd.BusServer(gw1, Bus_Socket, rpc, writable)
+	if Gateway_Port:
+		gateway.Gateway(gw1, rpc, host=Gateway_Host, port=Gateway_Port, max_age=Gateway_MaxAge, writable=writable)
 
-					time.sleep(sleep1)
-					continue
+	poller = scheduler.PollScheduler(gw1, list1, Poll_Intervals)
+	pubfilter = deadband.DeadbandFilter(gw1.registers, Deadbands, Relative_Deadbands, Heartbeat, units=derived.UNITS)
 
-				# error:
-				if not 'Status' in info: 
-					with mqttlock:
-						mq1.publish(f"{mqttpvtopic}/status", "Script error")
+	metrics = derived.DerivedMetrics()
+	encoder = payload.Encoder(gw1.registers, Payload_Encoding, units=derived.UNITS)
+	if Derived_File and metrics.load(Derived_File):
+		logging.info(f"restored today's derived values from {Derived_File}")
 
-					logging.error(f"Error: no status in data, data: {info}")
-					time.sleep(60)
-					continue
+	store = None
+	if Store_File:
+		store = tsstore.TimeSeriesStore(Store_File, tsstore.numeric_fields(gw1.registers, list1), flush=Store_Flush)
 
-				for k,v in info.items():
-					if isinstance(v, float):
-						info[k] = round(v,3)
-
-				logging.debug(pp.pformat(info))
+	sleep1 = 0.2
+	publish = 5
+	lastrun = time.monotonic()
+	lastmetrics = time.monotonic()
+	info = {}
 
-				with mqttlock:
-					mq1.publish(f"{mqttpvtopic}/status", info.pop('Status'))
-					mq1.publish(f"{mqttpvtopic}/data", json.dumps(info))
+	while True:
+		
+#		try:
 
-				logging.info(f"PV 2 MQTT update send {lastrun}")
-			
-			time.sleep(sleep1)
+			data = poller.poll()
+			if data:
+				rpc.observe(data)
+				data.update(metrics.update(data))
+				if table:
+					table.update(data)
+
+			if time.monotonic() - lastmetrics >= Metrics_Interval:
+				lastmetrics = time.monotonic()
+				pub.publish(f"{mqttpvtopic}/metrics", json.dumps({**gw1.metrics.snapshot(), "publisher": pub.stats(), "read_rpc": rpc.stats()}))
+
+				if Derived_File:
+					try:
+						metrics.save(Derived_File)
+					except OSError as e:
+						logging.error(f"Error writing {Derived_File}: {e}")
+
+				if Prometheus_File:
+					try:
+						gw1.metrics.write_prometheus(Prometheus_File)
+					except OSError as e:
+						logging.error(f"Error writing {Prometheus_File}: {e}")
+
+			if data == {}: # registers due, but no info:
+				logging.warning(f"No data from inverter received")
+				info = {}
+				poller.reset()
+
+				if time.monotonic() - lastrun >= publish:
+					lastrun = time.monotonic()
+					if pubfilter.changes({"Status": "Offline"}):
+						pubfilter.reset()
+						pubfilter.commit({"Status": "Offline"})
+						pub.publish(f"{mqttpvtopic}/status", "Offline")
+
+				time.sleep(max(sleep1, gw1.probe_wait()))
+				continue
+
+			if data:
+				info.update(data)
+
+			if time.monotonic() - lastrun < publish:
+				time.sleep(poller.wait(sleep1))
+				continue
+
+			lastrun = time.monotonic()
+
+			# error:
+			if not 'Status' in info: 
+				pub.publish(f"{mqttpvtopic}/status", "Script error")
+
+				logging.error(f"Error: no status in data, data: {info}")
+				time.sleep(60)
+				continue
+
+			data = dict(info) # rounded by the encoder
+
+			if log.isEnabledFor(logging.DEBUG):
+				logging.debug(pp.pformat(data))
+
+			if store:
+				store.append(data)
+
+			changed = pubfilter.changes(data)
+			if not changed:
+				logging.debug("nothing changed, not published")
+				continue
+
+			published = {}
+			if 'Status' in changed:
+				published['Status'] = changed.pop('Status')
+				pub.publish(f"{mqttpvtopic}/status", published['Status'])
+
+			if Per_Field_Topics:
+				for k,v in changed.items():
+					pub.publish(f"{mqttpvtopic}/{k}", encoder.value(k, v), retain=True)
+				published.update(changed)
+			elif changed:
+				data.pop('Status')
+				body, schema = encoder.encode(data)
+				if schema:
+					pub.publish(f"{mqttpvtopic}/schema/{schema['id']}", json.dumps(schema), retain=True)
+				pub.publish(f"{mqttpvtopic}/data", body)
+				published.update(data)
+
+			pubfilter.commit(published)
+
+			logging.info(f"PV 2 MQTT update send {datetime.datetime.now()} ({len(changed)} changed)")
 
 #		except Exception as e: 
 #			logging.error(f"Error: {e}")
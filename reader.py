@@ -1,31 +1,68 @@
 #!/usr/bin/env python3
 
-import sys
+import time
+import argparse
 import growatt
 import ModBusDev as MBD
+import busd
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument("port", nargs="?", help="RS485 device of the inverter (e.g. the pty of simulator.py)")
+parser.add_argument("--record", metavar="FILE", help="capture all responses to FILE")
+parser.add_argument("--replay", metavar="FILE", help="read from a capture instead of the inverter")
+parser.add_argument("--watch", type=float, metavar="SECONDS", help="print --keys every SECONDS instead of all registers")
+parser.add_argument("--keys", default="Status,PV_P,AC_P,Bat_SOC,Bat_P_charge,Bat_P_discharge", help="comma separated keys for --watch")
+parser.add_argument("--bus", action="store_true", help="show the values of the bus owner (busd.py / pv2mqtt) instead of opening the port")
+parser.add_argument("--table", default=busd.TABLE, help=f"value table of the bus owner (default {busd.TABLE})")
+args = parser.parse_args()
+
 RS485Port = '/dev/serial/by-path/platform-3f980000.usb-usb-0:1.3:1.0-port0' # Inverter
 
-inv1 = growatt.SPH(
-    device=RS485Port,
-    stopbits=1,
-    parity="N",
-    baud=9600,
-    timeout=1,
-    unit=1
-)
+if args.port:
+    RS485Port = args.port
+
+if args.bus:
+    inv1 = busd.BusClient(table=args.table)
+    registers = growatt.SPH.registers
+    values = inv1.snapshot().values
+    read_all = lambda rtype: {k: v for k, v in values.items() if k in registers and registers[k].rtype == rtype}
+else:
+    inv1 = growatt.SPH(
+        device=RS485Port,
+        stopbits=1,
+        parity="N",
+        baud=9600,
+        timeout=1,
+        unit=1,
+        capture=args.record,
+        replay=args.replay
+    )
+    registers = inv1.registers
+    read_all = inv1.read_all
 
 
 
 print(f"{inv1}:")
 
+if args.watch:
+	keys = args.keys.split(",")
+	print("time     " + " ".join(f"{k:>16}" for k in keys))
+
+	for sample in inv1.stream(keys, args.watch):
+		line = time.strftime("%H:%M:%S", time.localtime(sample.time))
+		values = [sample.values.get(k, "-") for k in keys]
+		line += " " + " ".join(f"{v:>16.2f}" if isinstance(v, float) else f"{str(v):>16}" for v in values)
+		if sample.skipped:
+			line += f"  ({sample.skipped} skipped)"
+		print(line, flush=True)
+
 
 
 print("\nInput Registers:")
 
-for k, v in inv1.read_all(MBD.registerType.INPUT).items():
-	address, length, rtype, dtype, vtype, label, fmt, sf = inv1.registers[k]
+for k, v in read_all(MBD.registerType.INPUT).items():
+	address, length, rtype, dtype, vtype, label, fmt, sf = registers[k]
 
 	if type(fmt) is list or type(fmt) is dict:
 		print(f"\t{label: <40}: {v}")
@@ -36,12 +73,12 @@ for k, v in inv1.read_all(MBD.registerType.INPUT).items():
 
 print("\nHolding Registers:")
 
-for k, v in inv1.read_all(MBD.registerType.HOLDING).items():
-	if not k in inv1.registers:
+for k, v in read_all(MBD.registerType.HOLDING).items():
+	if not k in registers:
 		print(k,v)
 		continue
 
-	address, length, rtype, dtype, vtype, label, fmt, sf = inv1.registers[k]
+	address, length, rtype, dtype, vtype, label, fmt, sf = registers[k]
 #
 	if type(fmt) is list:
 		print(f"\t{label: <40}: {v}")
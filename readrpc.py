@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Coalesced on-demand reads (e.g. the <topic>/read RPC of pv2mqtt).
+#
+# Requests name register keys and/or raw address ranges:
+#
+#   {"id": "dash1", "keys": ["Bat_SOC", "PV_P"], "max_age": 10,
+#    "ranges": [{"rtype": "HOLDING", "address": 1000, "count": 20}]}
+#
+# Requests arriving within `window` s are merged: values not older than the
+# `max_age` of the request (s, default 0: read) are served from the freshest
+# known value (polled or read before), everything else is read in one batch
+# plan with DEMAND priority. So N dashboards asking at once cost one read.
+#
+#   rpc = ReadCoalescer(inv, reply=lambda req, ans: print(ans))
+#   rpc.observe(inv.read_list(keys))     # feed polled values
+#   rpc.submit({"id": 1, "keys": ["Bat_SOC"]})
+#
+# Answer: {"id", "values": {key: value}, "ranges": [{"rtype", "address", "count",
+# "registers"}], "missing": [keys / ranges not read], "age": s of the oldest value}
+
+import time
+import queue
+import logging
+import threading
+
+import ModBusDev as MBD
+
+
+class Request:
+	def __init__(self, dev, msg, reply):
+		if not isinstance(msg, dict):
+			raise ValueError("request must be a json object")
+
+		self.msg = msg
+		self.reply = reply
+		self.id = msg.get("id")
+		self.max_age = float(msg.get("max_age", 0))
+		self.keys = list(msg.get("keys", ()))
+		self.ranges = []
+
+		for k in self.keys:
+			if k not in dev.registers:
+				raise ValueError(f"unknown key {k}")
+
+		for r in msg.get("ranges", ()):
+			rtype = MBD.registerType[r.get("rtype", "HOLDING")]
+			address, count = int(r["address"]), int(r["count"])
+			if not 0 <= address < address + count <= 0x10000:
+				raise ValueError(f"invalid range {address}:{count}")
+			self.ranges.append((rtype, address, count))
+
+
+class ReadCoalescer:
+	def __init__(self, dev, reply, window=0.05, maxqueue=100):
+		self.dev = dev
+		self.reply = reply
+		self.window = window
+
+		self.lock = threading.Lock()
+		self.values = {}		# key: (value, monotonic time)
+		self.raw = {}			# (rtype, address): (register, monotonic time)
+		self.queue = queue.Queue(maxqueue)
+		self.counts = {"requests": 0, "merged": 0, "reads": 0, "hits": 0, "errors": 0}
+		self.recorder = None		# next recorder of the device, see listen()
+
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def listen(self):
+		"""keep the raw cache up to date with every read of the device (poller included)
+
+		The coalescer is chained in as recorder of the device, see capture.CaptureWriter.
+		"""
+		self.recorder = self.dev.recorder
+		self.dev.recorder = self
+
+	def record(self, unit, rtype, address, registers, t=None):
+		if unit == self.dev.unit:
+			self._store_raw(rtype, address, registers)
+		if self.recorder:
+			self.recorder.record(unit, rtype, address, registers, t)
+
+	def call(self, msg, timeout=30):
+		"""submit a request and wait for the answer"""
+		done = threading.Event()
+		ans = {}
+		self.submit(msg, lambda req, a: (ans.update(a), done.set()))
+		if not done.wait(timeout):
+			raise TimeoutError("no answer from the device")
+		return ans
+
+	def observe(self, values, t=None):
+		"""remember values read elsewhere (e.g. by the poll loop)"""
+		t = time.monotonic() if t is None else t
+		with self.lock:
+			for k, v in values.items():
+				self.values[k] = (v, t)
+
+	def cached(self, rtype, address, count, max_age):
+		"""registers of the range if all are known and not older than max_age s, else None"""
+		now = time.monotonic()
+		with self.lock:
+			regs = [self.raw.get((rtype, a)) for a in range(address, address + count)]
+		if any(v is None or now - v[1] > max_age for v in regs):
+			return None
+		self._count("hits")
+		return [v[0] for v in regs]
+
+	def submit(self, msg, reply=None):
+		"""queue a request (parsed json), invalid requests are answered right away
+
+		`reply(msg, answer)` replaces the reply function of the coalescer for this request.
+		"""
+		reply = reply or self.reply
+		try:
+			req = Request(self.dev, msg, reply)
+			self.queue.put_nowait(req)
+		except (KeyError, ValueError, TypeError, queue.Full) as e: # KeyError: rtype name or "address" / "count" missing
+			self._count("errors")
+			reply(msg, {"id": msg.get("id") if isinstance(msg, dict) else None, "error": str(e) or "queue full"})
+
+	def stats(self):
+		with self.lock:
+			return {**self.counts, "queue": self.queue.qsize()}
+
+	def _count(self, name, n=1):
+		with self.lock:
+			self.counts[name] += n
+
+	# ----------------------------------------------------------------------------------
+	def _stale_keys(self, requests, now):
+		stale = set()
+		with self.lock:
+			for req in requests:
+				for k in req.keys:
+					v = self.values.get(k)
+					if v is None or now - v[1] > req.max_age:
+						stale.add(k)
+		return stale
+
+	def _stale_ranges(self, requests, now):
+		"""{rtype: [(address, count), ...]} of requested ranges with a register too old"""
+		stale = {}
+		with self.lock:
+			for req in requests:
+				for rtype, address, count in req.ranges:
+					for a in range(address, address + count):
+						v = self.raw.get((rtype, a))
+						if v is None or now - v[1] > req.max_age:
+							stale.setdefault(rtype, []).append((address, count))
+							break
+		return stale
+
+	def _read_ranges(self, rtype, ranges):
+		"""read the merged ranges with as few requests as possible"""
+		dev = self.dev
+		limit = dev._limit(rtype)
+
+		chunks = set()
+		for address, count in ranges:
+			for a in range(address, address + count, limit):
+				chunks.add((None, a, min(limit, address + count - a)))
+
+		for batch in dev._plan_batches(sorted(chunks, key=lambda c: c[1:]), limit):
+			start = batch[0][1]
+			length = max(a + n for k, a, n in batch) - start
+
+			try:
+				registers = dev._read_raw(start, length, rtype)
+			except MBD.RequestRejected:
+				registers = None # read the chunks one by one
+				for k, a, n in batch:
+					try:
+						self._store_raw(rtype, a, dev._read_raw(a, n, rtype))
+					except MBD.RequestRejected:
+						pass
+					self._count("reads")
+
+			self._count("reads")
+			self._store_raw(rtype, start, registers)
+
+	def _store_raw(self, rtype, address, registers):
+		if registers is None:
+			return
+
+		t = time.monotonic()
+		with self.lock:
+			for i, v in enumerate(registers):
+				self.raw[(rtype, address + i)] = (v, t)
+
+	def _answer(self, req, started):
+		ans = {"id": req.id, "values": {}, "ranges": [], "missing": []}
+		age = 0.0
+		hits = 0		# keys / ranges served from values known before
+
+		with self.lock:
+			for k in req.keys:
+				v = self.values.get(k)
+				if v is None or (v[1] < started and started - v[1] > req.max_age):
+					ans["missing"].append(k)
+					continue
+				ans["values"][k] = v[0]
+				age = max(age, started - v[1])
+				hits += v[1] < started
+
+			for rtype, address, count in req.ranges:
+				regs = [self.raw.get((rtype, a)) for a in range(address, address + count)]
+				r = {"rtype": rtype.name, "address": address, "count": count}
+
+				if any(v is None or (v[1] < started and started - v[1] > req.max_age) for v in regs):
+					ans["missing"].append(r)
+					continue
+
+				ans["ranges"].append({**r, "registers": [v[0] for v in regs]})
+				age = max(age, max(started - v[1] for v in regs))
+				hits += all(v[1] < started for v in regs)
+
+			self.counts["hits"] += hits
+
+		ans["age"] = round(age, 3)
+		return ans
+
+	def _serve(self, requests):
+		started = time.monotonic()
+		keys = self._stale_keys(requests, started)
+		ranges = self._stale_ranges(requests, started)
+
+		self._count("requests", len(requests))
+		self._count("merged", len(requests) - 1)
+
+		with self.dev.buslock.priority(MBD.DEMAND):
+			if keys:
+				self.observe(self.dev.read_list(keys, cached=False)) # stale: not from the holding cache either
+				self._count("reads")
+
+			for rtype, r in ranges.items():
+				self._read_ranges(rtype, r)
+
+		for req in requests:
+			try:
+				req.reply(req.msg, self._answer(req, started))
+			except Exception as e:
+				logging.error(f"read reply {req.id}: {e}")
+
+	def run(self):
+		while True:
+			requests = [self.queue.get()]
+			deadline = time.monotonic() + self.window
+
+			while (wait := deadline - time.monotonic()) > 0:
+				try:
+					requests.append(self.queue.get(timeout=wait))
+				except queue.Empty:
+					break
+
+			try:
+				self._serve(requests)
+			except Exception as e:
+				logging.error(f"read requests {[r.id for r in requests]}: {e}")
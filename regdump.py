@@ -13,13 +13,35 @@ root = logging.getLogger()
 root.setLevel(logging.WARNING)
 root.addHandler(handler)
 
+import json
+import argparse
+
 from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 from pymodbus.exceptions import ModbusIOException
 from pymodbus.payload import BinaryPayloadBuilder
 
 
+# regdump.py [port]                                     dump 0-124 and 1000-1124 (holding)
+# regdump.py [port] --scan [--range 0:4000] --save a.json  find and dump implemented registers
+# regdump.py --diff a.json b.json                       changed registers, with growatt.SPH keys
+# regdump.py --bus [--scan ...]                         through the bus owner (busd.py / pv2mqtt)
+parser = argparse.ArgumentParser()
+parser.add_argument("port", nargs="?", help="RS485 device of the inverter (e.g. the pty of simulator.py)")
+parser.add_argument("--scan", action="store_true", help="discover the implemented input and holding registers")
+parser.add_argument("--range", default="0:4000", help="address range to scan (default 0:4000)")
+parser.add_argument("--max", type=int, default=125, help="largest request to try (default 125)")
+parser.add_argument("--step", type=int, default=8, help="probe gaps every STEP registers (default 8, 1: exact)")
+parser.add_argument("--save", metavar="FILE", help="save the scanned registers as json")
+parser.add_argument("--diff", nargs=2, metavar="FILE", help="compare two saved dumps")
+parser.add_argument("--bus", action="store_true", help="read through the bus owner (busd.py / pv2mqtt) instead of opening the port")
+parser.add_argument("--socket", default="/tmp/growatt.sock", help="socket of the bus owner (default /tmp/growatt.sock)")
+args = parser.parse_args()
+
 RS485Port = '/dev/serial/by-path/platform-3f980000.usb-usb-0:1.3:1.0-port0'
 
+if args.port:
+	RS485Port = args.port
+
 
 class Inverter:
 	def __init__(self, RS485Port):
@@ -28,14 +50,43 @@ class Inverter:
 		logging.info('Modbus connected')
 
 	def read(self, start, length=1, regtype="holding"):
+		if regtype == "input":
+			return self.client.read_input_registers(start, length).registers
 		return self.client.read_holding_registers(start, length).registers
 
+	def try_read(self, start, length=1, regtype="holding"):
+		"""registers or None on exception, timeout or short answer"""
+		if regtype == "input":
+			result = self.client.read_input_registers(start, length)
+		else:
+			result = self.client.read_holding_registers(start, length)
+
+		if isinstance(result, ModbusIOException) or result.isError() or len(result.registers) != length:
+			return None
+		return result.registers
+
 	def close(self):
 		self.client.close()
 
 
+class BusInverter(Inverter):
+	"""reads through the UNIX socket of the bus owner, see busd.py"""
+
+	def __init__(self, path):
+		import busd
+		self.client = busd.BusClient(socket=path)
+
+	def read(self, start, length=1, regtype="holding"):
+		registers = self.try_read(start, length, regtype)
+		if registers is None:
+			raise IOError(f"{regtype} {start}:{length} not readable")
+		return registers
+
+	def try_read(self, start, length=1, regtype="holding"):
+		return self.client.read_raw(regtype.upper(), start, length)
+
+
 
-Inv1 = Inverter(RS485Port)
 reglimit = 100
 displ = 20
 
@@ -67,12 +118,148 @@ def regdump(start, length):
 	disphex(d, start)
 	
 	
+class Scanner:
+	"""find the implemented address ranges of a register space
+
+	Implemented registers are read in windows of the largest accepted request
+	size, the end of a range is found by bisecting the request length. Gaps are
+	probed every `step` registers (ranges shorter than `step` can be missed),
+	the exact start of the next range is bisected again. If the register after
+	a shortened read answers, the device limits the request size.
+	"""
+
+	def __init__(self, inv, regtype, size=125, step=8):
+		self.inv = inv
+		self.regtype = regtype
+		self.size = size
+		self.step = step
+		self.registers = {}		# address: value
+		self.requests = 0
+
+	def _read(self, start, length):
+		self.requests += 1
+		return self.inv.try_read(start, length, self.regtype)
+
+	def _extent(self, start, length):
+		"""number of registers answered from start on (at most length)"""
+		d = self._read(start, length)
+		if d is None:
+			lo, hi = 0, length		# lo answers, hi doesn't
+			while hi - lo > 1:
+				mid = (lo + hi) // 2
+				r = self._read(start, mid)
+				if r is None:
+					hi = mid
+				else:
+					lo, d = mid, r
+
+			if lo and self._read(start + lo, 1) is not None:
+				self.size = lo
+				logging.info(f"{self.regtype}: {length} registers not accepted, reading at most {lo}")
+
+		if d:
+			self.registers.update(zip(range(start, start + len(d)), d))
+		return len(d) if d else 0
+
+	def _next(self, start, end):
+		"""first implemented address after the unimplemented `start` (or end)"""
+		p = start + self.step
+		while p < end and self._read(p, 1) is None:
+			p += self.step
+		if p >= end:
+			return end
+
+		lo, hi = max(start, p - self.step), p		# lo doesn't answer up to p, hi does
+		while hi - lo > 1:
+			mid = (lo + hi) // 2
+			if self._read(mid, p - mid + 1) is None:
+				lo = mid
+			else:
+				hi = mid
+		return hi
+
+	def scan(self, start, end):
+		pos = start
+		while pos < end:
+			n = self._extent(pos, min(self.size, end - pos))
+			pos = pos + n if n else self._next(pos, end)
+		return self.registers
+
+	def ranges(self):
+		"""[(start, [values]), ...] of contiguous implemented registers"""
+		ranges = []
+		for a in sorted(self.registers):
+			if ranges and ranges[-1][0] + len(ranges[-1][1]) == a:
+				ranges[-1][1].append(self.registers[a])
+			else:
+				ranges.append((a, [self.registers[a]]))
+		return ranges
+
+
+def scan(start, end):
+	dump = {"time": time.time(), "port": RS485Port}
+
+	for regtype in ["input", "holding"]:
+		t = time.monotonic()
+		sc = Scanner(Inv1, regtype, args.max, args.step)
+		sc.scan(start, end)
+
+		dump[regtype] = sc.ranges()
+		print(f"\n{regtype}: {len(sc.registers)} registers in {len(dump[regtype])} ranges, max request {sc.size}, {sc.requests} requests, {time.monotonic() - t:.1f}s")
+
+		for a, d in dump[regtype]:
+			print(f"\t{a}-{a + len(d) - 1}")
+			disphex(d, a)
+
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(dump, f)
+
+
+def load_dump(path):
+	with open(path) as f:
+		dump = json.load(f)
+
+	return {regtype: {a + i: v for a, d in dump.get(regtype, []) for i, v in enumerate(d)} for regtype in ["input", "holding"]}
+
+
+def diff(path1, path2):
+	import growatt
+	import ModBusDev as MBD
+
+	a = load_dump(path1)
+	b = load_dump(path2)
+
+	for regtype in ["input", "holding"]:
+		rtype = MBD.registerType[regtype.upper()]
+		old, new = a[regtype], b[regtype]
+
+		changed = sorted(k for k in old.keys() | new.keys() if old.get(k) != new.get(k))
+		print(f"\n{regtype}: {len(changed)} registers changed")
+
+		for addr in changed:
+			key = growatt.SPH.registers.lookup(rtype, addr) or ""
+			if key and addr != growatt.SPH.registers[key].address:
+				key += f"+{addr - growatt.SPH.registers[key].address}"
+			print(f"\t{addr:5}: {str(old.get(addr, '-')):>6} -> {str(new.get(addr, '-')):<6} {key}")
+
+
 # =====================================================
 
-regdump(   0,125)
-regdump(1000,125)
+if args.diff:
+	diff(*args.diff)
+	sys.exit()
+
+Inv1 = BusInverter(args.socket) if args.bus else Inverter(RS485Port)
+
+if args.scan:
+	start, end = (int(x) for x in args.range.split(":"))
+	scan(start, end)
+else:
+	regdump(   0,125)
+	regdump(1000,125)
 
-#regdump(3000,125)
+	#regdump(3000,125)
 
 Inv1.close()
 
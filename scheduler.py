@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Per register poll intervals.
+#
+# Every register is read at its own interval: `dev.pollintervals` (set by the
+# device class, e.g. growatt.SPH), overridden by the `intervals` given here,
+# falling back to `dev.pollinterval`. Due times are aligned to a grid of the
+# interval, so registers with equal (or multiple) intervals fall due together
+# and each poll() merges all due registers into the cached batch plan of
+# ModBusDev.read_list().
+#
+#   poller = PollScheduler(inv, ["PV_P", "AC_P", "SerialNo"], {"PV_P": 0.5})
+#   while True:
+#       data = poller.poll()
+#       time.sleep(poller.wait())
+
+import math
+import time
+
+
+class PollScheduler:
+	retry = 5		# s, registers missing from a result are read again after at most this
+
+	def __init__(self, dev, keys, intervals=None):
+		self.dev = dev
+		self.intervals = {}
+
+		overrides = intervals or {}
+		for k in keys:
+			if k not in dev.registers:
+				continue
+			self.intervals[k] = overrides.get(k, dev.pollintervals.get(k, dev.pollinterval))
+
+		self.reset()
+
+	def reset(self):
+		"""make all registers due, e.g. after the device was offline"""
+		self.due = dict.fromkeys(self.intervals, 0.0)
+
+	def _next(self, now, interval):
+		return (math.floor(now / interval) + 1) * interval
+
+	def poll(self, now=None):
+		"""read all due registers, returns their values or None if nothing was due
+
+		If the device did not answer at all, the registers stay due. Registers
+		missing from a partial result (failed or rejected batch) are retried after
+		`retry` s instead of a whole interval.
+		"""
+		if now is None:
+			now = time.monotonic()
+
+		due = frozenset(k for k, t in self.due.items() if t <= now)
+		if not due:
+			return None
+
+		results = self.dev.read_list(due)
+
+		if results:
+			for k in due:
+				t = self._next(now, self.intervals[k])
+				self.due[k] = t if k in results else min(t, now + self.retry)
+
+		return results
+
+	def wait(self, limit=None, now=None):
+		"""seconds until the next register is due (at most `limit`)"""
+		if now is None:
+			now = time.monotonic()
+
+		wait = max(0.0, min(self.due.values(), default=now) - now)
+		if limit is not None:
+			wait = min(wait, limit)
+		return wait
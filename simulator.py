@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Growatt SPH Modbus simulator, built from the growatt.SPH register map.
+#
+# Serves input and holding registers over Modbus TCP and/or RTU on a pty
+# pair, with configurable response latency, baud rate pacing, a maximum
+# number of registers per request, short responses, dropped frames and
+# time varying values (PV curve, battery SOC, energy counters).
+#
+#   ./simulator.py --rtu --link /tmp/ttySPH      # then: ./reader.py /tmp/ttySPH
+#   ./simulator.py --tcp 5020 --latency 0.05 --drop 0.01
+#   ./simulator.py --bench 30                     # throughput / latency benchmark
+
+import os
+import sys
+import tty
+import math
+import time
+import random
+import select
+import struct
+import logging
+import argparse
+import datetime
+import threading
+import socketserver
+
+from pymodbus.utilities import computeCRC
+
+import growatt
+import ModBusDev as MBD
+
+rt = MBD.registerType
+dt = MBD.registerDataType
+
+
+class Profile:
+	"""link and device behaviour"""
+
+	def __init__(self, **kwargs):
+		self.unit = kwargs.get("unit", 1)
+		self.latency = kwargs.get("latency", 0.03)		# s, device turnaround
+		self.baud = kwargs.get("baud", 9600)				# RTU pacing, None: no pacing
+		self.maxregs = kwargs.get("maxregs", 125)		# more per request: exception 3
+		self.short = kwargs.get("short", 0.0)			# probability of a truncated answer
+		self.drop = kwargs.get("drop", 0.0)				# probability of no answer
+		self.speed = kwargs.get("speed", 1.0)			# simulated time factor
+		self.seed = kwargs.get("seed", None)
+
+		# implemented address ranges, everything else: exception 2
+		self.ranges = kwargs.get("ranges", {
+			rt.INPUT:   [(0, 125), (1000, 1125)],
+			rt.HOLDING: [(0, 125), (1000, 1125)],
+		})
+
+
+class SPHSim:
+	"""register image of one SPH plus a simple PV / battery model"""
+
+	def __init__(self, model=growatt.SPH, profile=None):
+		self.model = model
+		self.profile = profile or Profile()
+		self.rng = random.Random(self.profile.seed)
+		self.lock = threading.Lock()
+
+		self.image = {rt.INPUT: {}, rt.HOLDING: {}}
+
+		self.t0 = time.monotonic()
+		self.day0 = datetime.datetime.now()
+		self.last = None
+
+		self.soc = 50.0
+		self.energy = {
+			"Energy_total": 1234.5, "PV1_E_total": 700.0, "PV2_E_total": 600.0,
+			"E_2_user_total": 300.0, "E_2_grid_total": 800.0, "E_2_local_total": 900.0,
+			"Bat_E_discharge": 150.0, "Bat_E_charge": 170.0,
+		}
+
+		self.set("SerialNo", "SIM0000001")
+		self.set("FW-Build", "SIMFW-1.0.0")
+		self.set("On_Off", 1)
+		self.set("Active_P_Rate", 100)
+		self.set("Pmax", 5000)
+		self.set("ModbusVersion", 307)
+		self.set("BAT_CC", 100)
+		self.set("BAT_LV", 47.0)
+		self.set("BAT_StopDis", 46.0)
+		self.set("BAT_CV", 56.0)
+		self.set("Priority", 0)
+		self.set("GridFirst_StopSOC", 10)
+		self.set("BattFirst_StopSOC", 100)
+		self.set("BAT_Type", 1)
+
+		self.update()
+
+	# ------------------------------------------------------------------------------
+	def set(self, key, value):
+		"""store a decoded value into the register image"""
+		address, length, rtype, dtype, vtype, label, fmt, sf = self.model.registers[key]
+
+		if dtype == dt.STRING:
+			raw = str(value).encode(self.model.charset)[:length * 2].ljust(length * 2, b"\x00")
+			regs = list(struct.unpack(f">{length}H", raw))
+		elif dtype in [dt.UINT16, dt.INT16, dt.UINT32, dt.INT32, dt.FLOAT32]:
+			raw = value / sf
+			if dtype != dt.FLOAT32:
+				raw = int(round(raw))
+			regs = MBD.ModBusDev._encode_value(self.model, raw, dtype) # only the class byte / word order
+		else:
+			regs = list(value)
+
+		image = self.image[rtype]
+		for i, r in enumerate(regs):
+			image[address + i] = r & 0xffff
+
+	def now(self):
+		"""simulated wall clock"""
+		return self.day0 + datetime.timedelta(seconds=(time.monotonic() - self.t0) * self.profile.speed)
+
+	def update(self):
+		"""advance the PV / battery model to the current simulated time (holding self.lock)"""
+		now = self.now()
+		dth = 0 if self.last is None else (now - self.last).total_seconds() / 3600
+		self.last = now
+
+		h = now.hour + now.minute / 60 + now.second / 3600
+		sun = max(0.0, math.sin(math.pi * (h - 6) / 14)) if 6 < h < 20 else 0.0
+		pv = 5000 * sun * (0.85 + 0.15 * self.rng.random()) if sun else 0.0
+		load = 300 + 200 * self.rng.random()
+
+		surplus = pv * 0.97 - load
+		charge = min(surplus, 2500) if surplus > 0 and self.soc < 100 else 0.0
+		discharge = min(-surplus, 2500) if surplus < 0 and self.soc > 10 else 0.0
+		self.soc = min(100.0, max(0.0, self.soc + (charge - discharge) * dth / 10000 * 100))
+
+		ac = max(0.0, pv * 0.97 - charge + discharge)
+		export = max(0.0, surplus - charge)
+		user = max(0.0, -surplus - discharge)
+
+		for k, p in [("Energy_total", ac), ("PV1_E_total", pv / 2), ("PV2_E_total", pv / 2),
+		             ("E_2_user_total", user), ("E_2_grid_total", export), ("E_2_local_total", load),
+		             ("Bat_E_discharge", discharge), ("Bat_E_charge", charge)]:
+			self.energy[k] += p * dth / 1000
+
+		if charge:
+			status = 5
+		elif discharge:
+			status = 2
+		else:
+			status = 0 if not pv else 5
+
+		pvu = 320 + 10 * self.rng.random() if pv else 0.0
+		self.set("Status", status)
+		self.set("PV_P", pv)
+		for n in (1, 2):
+			self.set(f"PV{n}_U", pvu)
+			self.set(f"PV{n}_I", pv / 2 / pvu if pvu else 0)
+			self.set(f"PV{n}_P", pv / 2)
+		self.set("AC_P", ac)
+		self.set("AC_F", 50 + 0.05 * (self.rng.random() - 0.5))
+		self.set("AC1_U", 230 + 4 * (self.rng.random() - 0.5))
+		self.set("AC1_I", ac / 230)
+		self.set("AC1_P", ac)
+		self.set("Temp", 30 + pv / 500)
+		self.set("Bat_P_charge", charge)
+		self.set("Bat_P_discharge", discharge)
+		self.set("Bat_V", 48 + 6 * self.soc / 100)
+		self.set("Bat_SOC", round(self.soc))
+		self.set("P_AC_2_User", user)
+		self.set("P_AC_2_Grid", export)
+		self.set("P_Inv_2_local", load)
+		for k, v in self.energy.items():
+			self.set(k, v)
+		self.set("Sys-Date", (now.year, now.month, now.day))
+		self.set("Sys-Time", (now.hour, now.minute, now.second))
+
+	# ------------------------------------------------------------------------------
+	def _implemented(self, rtype, address, count):
+		return any(a <= address and address + count <= b for a, b in self.profile.ranges[rtype])
+
+	def handle(self, pdu):
+		"""answer a request PDU, returns the response PDU or None (dropped)"""
+		p = self.profile
+		fc = pdu[0]
+
+		if self.rng.random() < p.drop:
+			return None
+
+		if fc in (3, 4):
+			rtype = rt.HOLDING if fc == 3 else rt.INPUT
+			address, count = struct.unpack(">HH", pdu[1:5])
+
+			if not 1 <= count <= min(125, p.maxregs):
+				return struct.pack(">BB", fc | 0x80, 3)
+			if not self._implemented(rtype, address, count):
+				return struct.pack(">BB", fc | 0x80, 2)
+
+			with self.lock:
+				self.update()
+				image = self.image[rtype]
+				regs = [image.get(a, 0) for a in range(address, address + count)]
+
+			if count > 1 and self.rng.random() < p.short:
+				regs = regs[:self.rng.randrange(1, count)]
+
+			return struct.pack(f">BB{len(regs)}H", fc, 2 * len(regs), *regs)
+
+		elif fc == 6:
+			address, value = struct.unpack(">HH", pdu[1:5])
+			with self.lock:
+				self.image[rt.HOLDING][address] = value
+			return pdu[:5]
+
+		elif fc == 16:
+			address, count, nbytes = struct.unpack(">HHB", pdu[1:6])
+			if not self._implemented(rt.HOLDING, address, count):
+				return struct.pack(">BB", fc | 0x80, 2)
+
+			values = struct.unpack(f">{count}H", pdu[6:6 + 2 * count])
+			with self.lock:
+				for i, v in enumerate(values):
+					self.image[rt.HOLDING][address + i] = v
+			return pdu[:5]
+
+		return struct.pack(">BB", fc | 0x80, 1)
+
+	def pace(self, nbytes):
+		"""device turnaround plus wire time of request and answer"""
+		p = self.profile
+		wire = nbytes * 11 / p.baud if p.baud else 0
+		time.sleep(p.latency + wire)
+
+
+# ======================================================================================
+class _TCPHandler(socketserver.BaseRequestHandler):
+	def handle(self):
+		sim = self.server.sim
+		sock = self.request
+
+		while True:
+			header = self._recv(sock, 7)
+			if not header:
+				return
+			tid, pid, length, unit = struct.unpack(">HHHB", header)
+			pdu = self._recv(sock, length - 1)
+			if not pdu:
+				return
+
+			answer = sim.handle(pdu) if unit in (sim.profile.unit, 0, 0xff) else None
+			if answer is None:
+				continue
+
+			sim.pace(0)
+			sock.sendall(struct.pack(">HHHB", tid, 0, len(answer) + 1, unit) + answer)
+
+	@staticmethod
+	def _recv(sock, n):
+		data = b""
+		while len(data) < n:
+			chunk = sock.recv(n - len(data))
+			if not chunk:
+				return None
+			data += chunk
+		return data
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 64		# many clients connecting at once (default 5: SYN retries)
+
+
+def serve_tcp(sim, host="127.0.0.1", port=5020):
+	"""start a Modbus TCP server thread, returns the server (server.shutdown() stops it)"""
+	server = _TCPServer((host, port), _TCPHandler)
+	server.sim = sim
+
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+class RTUServer:
+	"""Modbus RTU on a pty pair, clients open `self.port`"""
+
+	def __init__(self, sim, link=None):
+		self.sim = sim
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.master)
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+
+		self.link = link
+		if link:
+			if os.path.islink(link):
+				os.remove(link)
+			os.symlink(self.port, link)
+
+		self.stopped = threading.Event()
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def _read(self, n, timeout=None):
+		data = b""
+		while len(data) < n:
+			r, w, x = select.select([self.master], [], [], timeout)
+			if not r:
+				return data
+			data += os.read(self.master, n - len(data))
+		return data
+
+	def _frame(self):
+		"""read one request frame, returns (unit, pdu) or None"""
+		head = self._read(2, 0.5)
+		if len(head) < 2:
+			return None
+
+		unit, fc = head
+		if fc in (3, 4, 6):
+			rest = self._read(6, 0.1)
+		elif fc == 16:
+			rest = self._read(5, 0.1)
+			if len(rest) == 5:
+				rest += self._read(rest[4] + 2, 0.1)
+		else:
+			self._read(256, 0.01) # resync: discard until silence
+			return None
+
+		frame = head + rest
+		if len(frame) < 4 or struct.unpack(">H", frame[-2:])[0] != computeCRC(frame[:-2]):
+			self._read(256, 0.01)
+			return None
+
+		return unit, frame[1:-2]
+
+	def run(self):
+		sim = self.sim
+		while not self.stopped.is_set():
+			request = self._frame()
+			if not request:
+				continue
+
+			unit, pdu = request
+			if unit not in (sim.profile.unit, 0): # the SPH also answers unit 0
+				continue
+
+			answer = sim.handle(pdu)
+			if answer is None:
+				continue
+
+			frame = struct.pack(">B", unit) + answer
+			frame += struct.pack(">H", computeCRC(frame))
+
+			sim.pace(len(pdu) + 3 + len(frame))
+			os.write(self.master, frame)
+
+	def close(self):
+		self.stopped.set()
+		if self.link and os.path.islink(self.link):
+			os.remove(self.link)
+
+
+# ======================================================================================
+def bench(seconds, profile, keys=None):
+	"""poll the simulator over RTU with ModBusDev, print throughput and latency"""
+	sim = SPHSim(growatt.SPH, profile)
+	server = RTUServer(sim)
+
+	inv = growatt.SPH(device=server.port, parity="N", baud=profile.baud or 9600, timeout=1, unit=profile.unit)
+	keys = keys or list(inv.registers)
+
+	lat = []
+	regs = 0
+	empty = 0
+	end = time.monotonic() + seconds
+	while time.monotonic() < end:
+		t = time.monotonic()
+		res = inv.read_list(keys)
+		lat.append(time.monotonic() - t)
+		regs += len(res)
+		if not res:
+			empty += 1
+
+	inv.disconnect()
+	server.close()
+
+	lat.sort()
+	pct = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1000
+	print(f"cycles: {len(lat)} ({len(lat) / seconds:.2f}/s), values: {regs / seconds:.1f}/s, empty cycles: {empty}")
+	print(f"cycle latency ms: p50={pct(0.5):.1f} p90={pct(0.9):.1f} p99={pct(0.99):.1f} max={lat[-1] * 1000:.1f}")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--tcp", type=int, metavar="PORT", help="serve Modbus TCP on PORT")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--rtu", action="store_true", help="serve Modbus RTU on a pty")
+	parser.add_argument("--link", help="symlink to the RTU pty")
+	parser.add_argument("--bench", type=float, metavar="SECONDS", help="run the RTU benchmark")
+	parser.add_argument("--unit", type=int, default=1)
+	parser.add_argument("--latency", type=float, default=0.03)
+	parser.add_argument("--baud", type=int, default=9600)
+	parser.add_argument("--maxregs", type=int, default=125)
+	parser.add_argument("--short", type=float, default=0.0)
+	parser.add_argument("--drop", type=float, default=0.0)
+	parser.add_argument("--speed", type=float, default=1.0)
+	parser.add_argument("--seed", type=int)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	profile = Profile(unit=args.unit, latency=args.latency, baud=args.baud, maxregs=args.maxregs,
+	                  short=args.short, drop=args.drop, speed=args.speed, seed=args.seed)
+
+	if args.bench:
+		bench(args.bench, profile)
+		sys.exit(0)
+
+	sim = SPHSim(growatt.SPH, profile)
+
+	if args.tcp:
+		serve_tcp(sim, args.host, args.tcp)
+		print(f"Modbus TCP on {args.host}:{args.tcp}")
+	if args.rtu or not args.tcp:
+		rtu = RTUServer(sim, args.link)
+		print(f"Modbus RTU on {rtu.port}" + (f" ({args.link})" if args.link else ""))
+
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		if args.rtu or not args.tcp:
+			rtu.close()
@@ -0,0 +1,57 @@
+# AsyncSPH polls many TCP inverters concurrently: N devices take about the
+# time of one, not N times as long.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import time
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import growatt
+import simulator
+
+KEYS = ["Status", "PV_P", "PV1_U", "AC_P", "Bat_SOC", "Energy_total", "Active_P_Rate", "BAT_LV"]
+
+
+def serve(n, latency):
+	servers = []
+	for i in range(n):
+		sim = simulator.SPHSim(growatt.SPH, simulator.Profile(latency=latency, baud=None, seed=i))
+		servers.append(simulator.serve_tcp(sim, port=0))
+	return servers
+
+
+async def poll(ports):
+	devs = [growatt.AsyncSPH(host="127.0.0.1", port=p, timeout=2) for p in ports]
+	start = time.monotonic()
+	results = await asyncio.gather(*(d.read_list(KEYS) for d in devs))
+	elapsed = time.monotonic() - start
+	for d in devs:
+		d.disconnect()
+	return results, elapsed
+
+
+def test_concurrent_polling():
+	level = logging.root.manager.disable
+	logging.disable(logging.WARNING)
+	servers = serve(10, latency=0.05)
+	try:
+		ports = [s.server_address[1] for s in servers]
+
+		results, one = asyncio.run(poll(ports[:1]))
+		assert set(results[0]) == set(KEYS)
+
+		results, ten = asyncio.run(poll(ports))
+		assert all(set(r) == set(KEYS) for r in results)
+
+		# sequential polling would take ~10x
+		assert ten < 2.5 * one
+	finally:
+		for s in servers:
+			s.shutdown()
+			s.server_close()
+		logging.disable(level)
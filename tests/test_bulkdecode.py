@@ -0,0 +1,97 @@
+# bulkdecode must decode every numeric and string SPH register like the
+# compiled per-block decoder (ModBusDev._compile / _decode_block).
+#
+#   python -m pytest tests
+
+import os
+import sys
+import math
+import random
+import logging
+import itertools
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymodbus.constants import Endian
+
+import growatt
+import bulkdecode
+import ModBusDev as MBD
+
+ORDERS = list(itertools.product([Endian.Big, Endian.Little], repeat=2))
+SAMPLES = 50
+
+
+class NoClient:
+	"""no bus, only the decoder is used"""
+
+	def connect(self):
+		return True
+
+	def close(self):
+		pass
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+	"""no log of the decode errors of random data"""
+	level = logging.root.manager.disable
+	logging.disable(logging.CRITICAL)
+	yield
+	logging.disable(level)
+
+
+def snapshots(rtype):
+	"""(start, samples x registers) of random values, ascii in string registers"""
+	rnd = random.Random(1)
+	entries = growatt.SPH.registers.sorted(rtype)
+	start = entries[0][1]
+	rows = np.array([[rnd.randrange(0x10000) for a in range(start, entries[-1][1] + entries[-1][2])] for i in range(SAMPLES)], dtype=np.uint16)
+
+	for k, address, length, rtype_, dtype, *rest in entries:
+		if dtype == MBD.registerDataType.STRING:
+			for i in range(SAMPLES):
+				for a in range(address, address + length):
+					rows[i, a - start] = rnd.randrange(0x21, 0x7f) << 8 | rnd.randrange(0x21, 0x7f)
+	return start, rows
+
+
+def expected(k, v):
+	"""a bulk value as the per-block decoder returns it"""
+	address, length, rtype, dtype, vtype, label, fmt, sf = growatt.SPH.registers[k]
+	if isinstance(v, bytes):
+		return vtype(v.decode(growatt.SPH.charset))
+	if isinstance(fmt, list):
+		return fmt[int(v)] if int(v) < len(fmt) else None # skipped by the decoder
+	if vtype in (int, float) or sf != 1:
+		return float(v)
+	return vtype(int(v))
+
+
+@pytest.mark.parametrize("rtype", list(MBD.registerType))
+@pytest.mark.parametrize("byteorder, wordorder", ORDERS)
+def test_equivalence(rtype, byteorder, wordorder):
+	dev = growatt.SPH(client=NoClient())
+	dev.byteorder = byteorder
+	dev.wordorder = wordorder
+
+	start, rows = snapshots(rtype)
+	columns = bulkdecode.decode(rows, growatt.SPH.registers, start, rtype, byteorder, wordorder)
+	plan = dev._compile(list(growatt.SPH.registers.sorted(rtype)))
+	assert columns
+
+	for i in range(SAMPLES):
+		decoded = dev._decode_block(plan, rows[i, plan[0] - start:plan[0] - start + plan[1]].tolist())
+
+		for k, col in columns.items():
+			want = expected(k, col[i])
+			if want is None:
+				assert k not in decoded
+			elif isinstance(want, float) and math.isnan(want):
+				assert math.isnan(decoded[k]), k
+			else:
+				assert decoded[k] == want, (k, i)
@@ -0,0 +1,80 @@
+# busd: readers of the shared value table never see a half written table,
+# the socket serves reads and allowlisted writes of the simulator.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import busd
+import growatt
+import simulator
+
+
+def write_table(path, ready, n):
+	table = busd.SnapshotTable(path, writer=True, size=1 << 16)
+	ready.set()
+	for i in range(1, n + 1):
+		# values of varying length: a torn read shows as mismatching fields
+		table.update({"a": i, "b": "x" * (i % 50), "c": i}, t=float(i))
+	table.map.close()
+
+
+def test_seqlock(tmp_path):
+	path = str(tmp_path / "growatt.tbl")
+	ready = multiprocessing.get_context("fork").Event()
+	writer = multiprocessing.get_context("fork").Process(target=write_table, args=(path, ready, 20000))
+	writer.start()
+	assert ready.wait(10)
+
+	table = busd.SnapshotTable(path)
+	reads = 0
+	last = 0
+	while writer.is_alive() or reads == 0:
+		snap = table.read()
+		if snap.values:
+			i = snap.values["a"]
+			assert snap.values == {"a": i, "b": "x" * (i % 50), "c": i}
+			assert snap.time == float(i)
+			assert snap.seq == 2 * i
+			assert i >= last
+			last = i
+		reads += 1
+
+	writer.join()
+	table.close()
+	assert reads > 100
+
+
+@pytest.fixture
+def bus(tmp_path):
+	level = logging.root.manager.disable
+	logging.disable(logging.WARNING)
+	sim = simulator.SPHSim(growatt.SPH, simulator.Profile(latency=0, baud=None, seed=1))
+	srv = simulator.serve_tcp(sim, port=0)
+	dev = growatt.SPH(host="127.0.0.1", port=srv.server_address[1], timeout=1)
+	server = busd.BusServer(dev, str(tmp_path / "growatt.sock"))
+	client = busd.BusClient(str(tmp_path / "growatt.sock"), str(tmp_path / "growatt.tbl"), timeout=5)
+	yield client
+	client.close()
+	server.close()
+	dev.disconnect()
+	srv.shutdown()
+	srv.server_close()
+	logging.disable(level)
+
+
+def test_socket(bus):
+	assert bus.read(["Active_P_Rate", "Bat_SOC"]).keys() == {"Active_P_Rate", "Bat_SOC"}
+	assert bus.write_many({"Active_P_Rate": 50}, verify=True) == {"Active_P_Rate": True}
+	assert bus.read_raw("HOLDING", growatt.SPH.registers["Active_P_Rate"].address, 1) == [50]
+
+	with pytest.raises(RuntimeError, match="not a writable register"):
+		bus.write_many({"Lim_Vac_low1_time": 100})
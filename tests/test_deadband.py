@@ -0,0 +1,43 @@
+# DeadbandFilter must pass every step of one register unit of scaled values,
+# despite the float error of raw * sf.
+#
+#   python -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import growatt
+from deadband import DeadbandFilter
+
+
+def test_scaled_steps():
+	db = DeadbandFilter(growatt.SPH.registers, {"V": 0.1, "kWh": 0.1})
+
+	for k in ("PV1_U", "Energy_total"):
+		sf = growatt.SPH.registers[k].sf
+		assert sf == 0.1
+
+		for r in range(30000):
+			assert db.significant(k, r * sf, (r + 1) * sf), (k, r)
+			assert db.significant(k, (r + 1) * sf, r * sf), (k, r)
+
+
+def test_below_band():
+	db = DeadbandFilter(growatt.SPH.registers, {"W": 5, "V": 0.1}, {"Bat_SOC": 0.02})
+
+	assert not db.significant("PV_P", 1000.0, 1004.9)
+	assert db.significant("PV_P", 1000.0, 1005.0)
+	assert not db.significant("PV1_U", 230.0, 230.05)
+	assert not db.significant("Bat_SOC", 50, 50.5)
+	assert db.significant("Bat_SOC", 50, 51)
+
+
+def test_heartbeat():
+	db = DeadbandFilter(growatt.SPH.registers, {"V": 0.1}, heartbeat=300)
+	db.commit({"PV1_U": 230.0}, now=0)
+
+	assert db.changes({"PV1_U": 230.0}, now=299) == {}
+	assert db.changes({"PV1_U": 230.0}, now=300) == {"PV1_U": 230.0}
+	assert db.changes({"PV1_U": 230.1}, now=1) == {"PV1_U": 230.1}
@@ -0,0 +1,70 @@
+# Modbus TCP gateway in front of the simulator: reads from the register
+# image, writes only of whole, writable registers.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymodbus.client.sync import ModbusTcpClient
+
+import growatt
+import gateway
+import simulator
+
+REGS = growatt.SPH.registers
+
+
+@pytest.fixture
+def client():
+	level = logging.root.manager.disable
+	logging.disable(logging.CRITICAL)
+	sim = simulator.SPHSim(growatt.SPH, simulator.Profile(latency=0, baud=None, seed=1))
+	srv = simulator.serve_tcp(sim, port=0)
+	dev = growatt.SPH(host="127.0.0.1", port=srv.server_address[1], timeout=1)
+	gw = gateway.Gateway(dev, port=0, timeout=5)
+	assert gw.server.server_address[0] == "127.0.0.1"
+
+	client = ModbusTcpClient("127.0.0.1", gw.port, timeout=5)
+	client.connect()
+	yield client
+	client.close()
+	gw.close()
+	dev.disconnect()
+	srv.shutdown()
+	srv.server_close()
+	logging.disable(level)
+
+
+def exception(result):
+	return result.exception_code if result.isError() else None
+
+
+def test_read_write(client):
+	address = REGS["Active_P_Rate"].address
+	assert client.read_holding_registers(address, 1, unit=1).registers == [100]
+
+	assert exception(client.write_register(address, 42, unit=1)) is None
+	assert client.read_holding_registers(address, 1, unit=1).registers == [42]
+
+	timer = REGS["BattFirst_Time1"].address
+	assert exception(client.write_registers(timer, [0x0130, 0x0500, 1], unit=1)) is None
+	assert client.read_holding_registers(timer, 3, unit=1).registers == [0x0130, 0x0500, 1]
+
+
+def test_rejected_writes(client):
+	timer = REGS["BattFirst_Time1"].address
+	assert exception(client.write_register(timer, 0x0130, unit=1)) == gateway.ILLEGAL_ADDRESS # part of a register
+	assert exception(client.write_registers(timer + 1, [0, 0, 0], unit=1)) == gateway.ILLEGAL_ADDRESS
+
+	cc = REGS["BAT_CC"].address
+	assert REGS["BAT_LV"].address == cc + 2
+	assert exception(client.write_registers(cc, [100, 0, 470], unit=1)) == gateway.ILLEGAL_ADDRESS # gap
+
+	assert exception(client.write_register(REGS["Lim_Vac_low1_time"].address, 5, unit=1)) == gateway.ILLEGAL_ADDRESS # not writable
+	assert exception(client.read_holding_registers(0xfff0, 2, unit=1)) == gateway.ILLEGAL_ADDRESS
@@ -0,0 +1,60 @@
+# Short answers of a bad link must not be learned as the request size limit of
+# the device (ModBusDev._split / probe_limits).
+#
+#   python -m pytest tests
+
+import os
+import sys
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import growatt
+import simulator
+import ModBusDev as MBD
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+	"""no log of every short answer"""
+	level = logging.root.manager.disable
+	logging.disable(logging.CRITICAL)
+	yield
+	logging.disable(level)
+
+
+@pytest.fixture
+def server(request):
+	sim = simulator.SPHSim(growatt.SPH, simulator.Profile(latency=0, baud=None, seed=1, **request.param))
+	srv = simulator.serve_tcp(sim, port=0)
+	yield srv.server_address[1]
+	srv.shutdown()
+	srv.server_close()
+
+
+@pytest.mark.parametrize("server", [{"short": 0.05}], indirect=True)
+def test_short_answers(server):
+	dev = growatt.SPH(host="127.0.0.1", port=server, timeout=1)
+	complete = 0
+
+	for i in range(200):
+		results = dev.read_all(MBD.registerType.INPUT)
+		complete += "PV_P" in results and "Energy_total" in results
+
+	dev.disconnect()
+
+	assert not dev._probed
+	assert all(n >= 2 for n in dev.limits.values()), dev.limits
+	assert () not in dev._splits.values()
+	assert complete > 150 # ~0.95^4 of the cycles: no short answer at all
+
+
+@pytest.mark.parametrize("server", [{"short": 0.05, "maxregs": 40}], indirect=True)
+def test_probe_short_answers(server):
+	dev = growatt.SPH(host="127.0.0.1", port=server, timeout=1)
+	limits = dev.probe_limits()
+	dev.disconnect()
+
+	assert limits == {MBD.registerType.INPUT: 40, MBD.registerType.HOLDING: 40}
@@ -0,0 +1,81 @@
+# BufferedPublisher: the spool offset survives a restart, messages paho keeps
+# while disconnected are not spooled a second time.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import time
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mqttpub
+
+Info = collections.namedtuple("Info", "rc")
+
+
+class FakeClient:
+	"""paho stand-in recording the published messages"""
+
+	def __init__(self, connected=True, rc=0):
+		self.up = connected
+		self.rc = rc
+		self.sent = []
+
+	def is_connected(self):
+		return self.up
+
+	def publish(self, topic, payload, qos=0, retain=False):
+		if self.rc == 0:
+			self.sent.append((topic, payload))
+		return Info(self.rc)
+
+
+def msg(i, qos=0):
+	return (f"pv2/{i}", str(i), qos, False, time.time())
+
+
+def publisher(client, **kwargs):
+	pub = mqttpub.BufferedPublisher(None, **kwargs)
+	pub.stop() # the tests drive the spool themselves
+	pub.client = client
+	return pub
+
+
+def test_spool_offset(tmp_path):
+	spool = str(tmp_path / "spool.jsonl")
+
+	pub = publisher(FakeClient(connected=False), spool=spool, rate=10)
+	pub._spool_write([msg(i) for i in range(25)])
+
+	pub.client = FakeClient()
+	assert not pub._spool_drain()
+	assert len(pub.client.sent) == 10
+	assert os.path.exists(f"{spool}.pos")
+
+	# restart: continues after the 10 messages sent
+	pub = publisher(FakeClient(), spool=spool, rate=10)
+	assert not pub._spool_drain()
+	assert pub._spool_drain()
+	assert pub.client.sent == [(f"pv2/{i}", str(i)) for i in range(10, 25)]
+	assert not os.path.exists(spool) and not os.path.exists(f"{spool}.pos")
+
+
+def test_offset_beyond_spool(tmp_path):
+	spool = str(tmp_path / "spool.jsonl")
+	with open(f"{spool}.pos", "w") as f:
+		f.write("1000")
+
+	pub = publisher(FakeClient(), spool=spool)
+	pub._spool_write([msg(0)])
+	pub = publisher(FakeClient(), spool=spool)
+	assert pub.spoolpos == 0
+
+
+def test_paho_queue(tmp_path):
+	spool = str(tmp_path / "spool.jsonl")
+	pub = publisher(FakeClient(rc=mqttpub.MQTT_ERR_NO_CONN), spool=spool)
+
+	assert pub._send(msg(0, qos=1)) # paho sends it after reconnecting
+	assert not pub._send(msg(1, qos=0))
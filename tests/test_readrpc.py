@@ -0,0 +1,69 @@
+# ReadCoalescer against the simulator: stale keys are read from the device,
+# not from the holding register cache of the device.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import logging
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import growatt
+import readrpc
+import simulator
+import ModBusDev as MBD
+
+
+@pytest.fixture
+def sim():
+	level = logging.root.manager.disable
+	logging.disable(logging.WARNING)
+	sim = simulator.SPHSim(growatt.SPH, simulator.Profile(latency=0, baud=None, seed=1))
+	srv = simulator.serve_tcp(sim, port=0)
+	sim.port = srv.server_address[1]
+	yield sim
+	srv.shutdown()
+	srv.server_close()
+	logging.disable(level)
+
+
+def test_stale_key(sim):
+	dev = growatt.SPH(host="127.0.0.1", port=sim.port, timeout=1)
+	rpc = readrpc.ReadCoalescer(dev, reply=None)
+
+	rpc.observe(dev.read_list(["Active_P_Rate"])) # polled, now in the holding cache too
+	sim.set("Active_P_Rate", 42) # changed on the inverter display
+
+	assert rpc.call({"keys": ["Active_P_Rate"], "max_age": 60})["values"] == {"Active_P_Rate": 100}
+
+	ans = rpc.call({"keys": ["Active_P_Rate"]})
+	assert ans["values"] == {"Active_P_Rate": 42}
+	assert ans["age"] == 0
+	dev.disconnect()
+
+
+def test_ranges_and_hits(sim):
+	dev = growatt.SPH(host="127.0.0.1", port=sim.port, timeout=1)
+	rpc = readrpc.ReadCoalescer(dev, reply=None)
+	rpc.listen()
+
+	address = dev.registers["Active_P_Rate"].address
+	ans = rpc.call({"ranges": [{"rtype": "HOLDING", "address": address, "count": 1}]})
+	assert ans["ranges"][0]["registers"] == [100]
+
+	# served from the image: counted from several threads at once
+	threads = [threading.Thread(target=lambda: [rpc.cached(MBD.registerType.HOLDING, address, 1, 60) for i in range(200)]) for n in range(4)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+	for i in range(5):
+		rpc.call({"ranges": [{"rtype": "HOLDING", "address": address, "count": 1}], "max_age": 60})
+
+	assert rpc.stats()["hits"] == 4 * 200 + 5
+	dev.disconnect()
@@ -0,0 +1,76 @@
+# TimeSeriesStore keeps its rows over a change of the field list and moves
+# stores of the older layout aside.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import math
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tsstore
+
+TIERS = (("raw", 0, 100), ("1min", 60, 10))
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+	level = logging.root.manager.disable
+	logging.disable(logging.WARNING)
+	yield
+	logging.disable(level)
+
+
+def fill(path, fields, n):
+	store = tsstore.TimeSeriesStore(path, fields, TIERS, flush=0)
+	for i in range(n):
+		store.append({k: i * (j + 1) for j, k in enumerate(fields)}, t=1000 + 10 * i)
+	store.close()
+
+
+def test_reopen(tmp_path):
+	path = str(tmp_path / "pv.ts")
+	fill(path, ["PV_P", "Bat_SOC"], 30)
+
+	store = tsstore.TimeSeriesStore(path, ["PV_P", "Bat_SOC"], TIERS)
+	times, cols = store.query(0, tier="raw")
+	store.close()
+
+	assert times == [1000 + 10 * i for i in range(30)]
+	assert cols["Bat_SOC"] == [2 * i for i in range(30)]
+
+
+def test_migrate_fields(tmp_path):
+	path = str(tmp_path / "pv.ts")
+	fill(path, ["PV_P", "Bat_SOC", "AC_P"], 150) # wraps the raw tier
+
+	store = tsstore.TimeSeriesStore(path, ["Bat_SOC", "Grid_P", "PV_P"], TIERS)
+	times, cols = store.query(0, tier="raw")
+	mtimes, mcols = store.query(0, tier="1min")
+	store.close()
+
+	assert times == [1000 + 10 * i for i in range(50, 150)]
+	assert cols["PV_P"] == [float(i) for i in range(50, 150)]
+	assert cols["Bat_SOC"] == [2.0 * i for i in range(50, 150)]
+	assert all(math.isnan(v) for v in cols["Grid_P"])
+
+	assert len(mtimes) == 10
+	assert all(math.isnan(v) for v in mcols["Grid_P"])
+	assert not os.path.exists(f"{path}.tmp")
+
+
+def test_old_format(tmp_path):
+	path = str(tmp_path / "pv.ts")
+	with open(path, "wb") as f:
+		f.write(tsstore.MAGIC[:4] + b"\x00\x01\x00\x00" + b"\x00" * 100)
+
+	store = tsstore.TimeSeriesStore(path, ["PV_P"], TIERS)
+	times, cols = store.query(0)
+	store.close()
+
+	assert times == []
+	assert os.path.exists(f"{path}.old")
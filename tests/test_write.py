@@ -0,0 +1,58 @@
+# write_many against the simulator: battery profile timers take the form
+# decode_timer publishes, values are verified by reading them back.
+#
+#   python -m pytest tests
+
+import os
+import sys
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import growatt
+import simulator
+
+
+@pytest.fixture
+def dev():
+	level = logging.root.manager.disable
+	logging.disable(logging.WARNING)
+	sim = simulator.SPHSim(growatt.SPH, simulator.Profile(latency=0, baud=None, seed=1))
+	srv = simulator.serve_tcp(sim, port=0)
+	dev = growatt.SPH(host="127.0.0.1", port=srv.server_address[1], timeout=1)
+	yield dev
+	dev.disconnect()
+	srv.shutdown()
+	srv.server_close()
+	logging.disable(level)
+
+
+def test_profile(dev):
+	profile = {
+		"BattFirst_Time1": "01:30 - 05:00 True",
+		"BattFirst_Time2": [0, 0, 0],
+		"BattFirst_StopSOC": 90,
+		"BattFirst_PowerRate": 80,
+		"Batt_AC_charge": True,
+		"GridFirst_Time1": "17:00 - 21:30 False",
+	}
+	assert set(profile) <= set(growatt.SPH.writable)
+
+	assert dev.write_many(profile, verify=True) == dict.fromkeys(profile, True)
+
+	values = dev.read_list(profile, cached=False)
+	profile["BattFirst_Time2"] = "00:00 - 00:00 False"
+	assert values == profile
+
+
+def test_not_verified(dev):
+	assert dev.write_many({"BAT_LV": 47.35}, verify=True) == {"BAT_LV": False}
+	assert dev.write_many({"BAT_LV": 47.3}, verify=True) == {"BAT_LV": True}
+
+
+@pytest.mark.parametrize("value", ["24:00 - 01:00 True", "01:00 - 02:60 True", "01:00-02:00", "01:00 - 02:00 yes"])
+def test_invalid_timer(dev, value):
+	with pytest.raises(ValueError):
+		dev.write_many({"LoadFirst_Time1": value})
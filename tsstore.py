@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# On-device time series store for decoded values.
+#
+# One memory mapped file with a ring buffer per tier (raw samples, 1 min and
+# 15 min means), every row of a tier holds the timestamp and one float64 per
+# field. Appends are collected in memory and written to the map in batches,
+# the map is only synced every `flush` s to spare the SD card: rows are
+# contiguous, so a flush only dirties the pages of the new rows (plus the
+# head / count of each tier). Values that are missing or not numeric are
+# stored as NaN.
+#
+# A store opened with other fields or tiers is migrated: the rows of the tiers
+# of the same name are copied, new fields start as NaN, removed fields are
+# dropped. Files of the older column layout are moved to <path>.old.
+#
+#   store = TimeSeriesStore("pv.ts", tsstore.numeric_fields(inv.registers, keys))
+#   store.append(inv.read_list(keys))
+#   times, cols = store.query(time.time() - 3600)      # finest tier covering the range
+#   store.close()
+
+import os
+import json
+import math
+import mmap
+import time
+import array
+import struct
+import logging
+import threading
+
+MAGIC = b"GWTS\x00\x02\x00\x00"
+HEADER = 4096		# magic, json length, json layout
+
+# (name, bucket seconds, rows): 1 day of 5 s samples, 1 week of minutes, 1 year of 15 min
+TIERS = (("raw", 0, 17280), ("1min", 60, 10080), ("15min", 900, 35040))
+
+
+def numeric_fields(registers, keys=None):
+	"""keys of registers decoded to numbers (no enums, strings, raw values)"""
+	fields = []
+	for k in keys or registers:
+		if k not in registers:
+			continue
+
+		r = registers[k]
+		if r.vtype in (int, float) and isinstance(r.fmt, str):
+			fields.append(k)
+	return fields
+
+
+class _Tier:
+	def __init__(self, buf, offset, name, seconds, rows, nfields):
+		self.name = name
+		self.seconds = seconds
+		self.rows = rows
+
+		self.width = nfields + 1	# time, fields
+
+		self.meta = buf[offset:offset + 16].cast("Q")		# head, count
+		offset += 16
+		self.data = buf[offset:offset + 8 * rows * self.width].cast("d")
+		offset += 8 * rows * self.width
+
+		self.end = offset
+		self.bucket = None		# [start, sums, counts] of the open bucket
+
+	@staticmethod
+	def size(rows, nfields):
+		return 16 + 8 * rows * (nfields + 1)
+
+	def time(self, j):
+		return self.data[j * self.width]
+
+	def value(self, j, n):
+		return self.data[j * self.width + 1 + n]
+
+	def write(self, t, row):
+		head, count = self.meta
+		self.data[head * self.width:(head + 1) * self.width] = array.array("d", [t, *row])
+
+		self.meta[0] = (head + 1) % self.rows
+		self.meta[1] = min(count + 1, self.rows)
+
+	def index(self, i):
+		"""ring position of the i-th oldest row"""
+		head, count = self.meta
+		return (head - count + i) % self.rows
+
+	def first(self):
+		return self.time(self.index(0)) if self.meta[1] else None
+
+	def search(self, t):
+		"""number of rows older than t"""
+		lo, hi = 0, self.meta[1]
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.time(self.index(mid)) < t:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def add(self, t, row):
+		"""add a sample to the mean of its bucket, returns the finished bucket or None"""
+		start = t - t % self.seconds
+		done = None
+
+		if self.bucket and self.bucket[0] != start:
+			done = self.close_bucket()
+
+		if not self.bucket:
+			self.bucket = [start, [0.0] * len(row), [0] * len(row)]
+
+		sums, counts = self.bucket[1], self.bucket[2]
+		for i, v in enumerate(row):
+			if not math.isnan(v):
+				sums[i] += v
+				counts[i] += 1
+
+		return done
+
+	def close_bucket(self):
+		start, sums, counts = self.bucket
+		self.bucket = None
+		return start, [s / n if n else math.nan for s, n in zip(sums, counts)]
+
+	def release(self):
+		self.meta.release()
+		self.data.release()
+
+
+class TimeSeriesStore:
+	def __init__(self, path, fields, tiers=TIERS, flush=300):
+		self.path = path
+		self.fields = list(fields)
+		self.flush_interval = flush
+		self.lock = threading.Lock()
+
+		layout = json.dumps({"fields": self.fields, "tiers": [list(t) for t in tiers]}).encode()
+		if len(MAGIC) + 4 + len(layout) > HEADER:
+			raise ValueError("too many fields for the header")
+
+		size = HEADER + sum(_Tier.size(rows, len(self.fields)) for name, seconds, rows in tiers)
+
+		old = self._layout(path)
+		if old is not None and old != layout:
+			self._migrate(json.loads(old), tiers)
+
+		fd = os.open(path, os.O_RDWR | os.O_CREAT)
+		try:
+			if not os.pread(fd, len(MAGIC), 0).startswith(MAGIC):
+				os.ftruncate(fd, size) # sparse on ext4
+				os.pwrite(fd, MAGIC + struct.pack(">I", len(layout)) + layout, 0)
+
+			self.map = mmap.mmap(fd, size)
+		finally:
+			os.close(fd)
+
+		buf = memoryview(self.map)
+		self.tiers = []
+		offset = HEADER
+		for name, seconds, rows in tiers:
+			tier = _Tier(buf, offset, name, seconds, rows, len(self.fields))
+			self.tiers.append(tier)
+			offset = tier.end
+		buf.release()
+
+		self.pending = []		# (t, row) not yet in the map
+		self.synced = time.monotonic()
+
+	@staticmethod
+	def _layout(path):
+		"""json layout of an existing store, None if there is none (yet)"""
+		try:
+			with open(path, "rb") as f:
+				header = f.read(HEADER)
+		except FileNotFoundError:
+			return None
+
+		if header.startswith(MAGIC):
+			n, = struct.unpack_from(">I", header, len(MAGIC))
+			return header[len(MAGIC) + 4:len(MAGIC) + 4 + n]
+
+		if header.startswith(MAGIC[:4]):
+			os.replace(path, f"{path}.old")
+			logging.warning(f"{path}: older store format, moved to {path}.old")
+			return None
+
+		if header.strip(b"\0"):
+			raise ValueError(f"{path} is not a time series store")
+		return None
+
+	def _migrate(self, old, tiers):
+		"""copy the rows of a store with other fields or tiers into the new layout"""
+		tmp = f"{self.path}.tmp"
+		if os.path.exists(tmp):
+			os.remove(tmp)
+
+		src = TimeSeriesStore(self.path, old["fields"], [tuple(t) for t in old["tiers"]])
+		dst = TimeSeriesStore(tmp, self.fields, tiers)
+		idx = [src.fields.index(k) if k in src.fields else None for k in self.fields]
+
+		for tier in dst.tiers:
+			s = next((t for t in src.tiers if t.name == tier.name), None)
+			if s is None:
+				continue
+
+			for i in range(max(0, s.meta[1] - tier.rows), s.meta[1]):
+				j = s.index(i)
+				tier.write(s.time(j), [s.value(j, n) if n is not None else math.nan for n in idx])
+
+		src.close()
+		dst.close()
+		os.replace(tmp, self.path)
+		logging.info(f"{self.path}: migrated to {len(self.fields)} fields")
+
+	def append(self, values, t=None):
+		"""queue one sample {field: value}"""
+		row = []
+		for k in self.fields:
+			v = values.get(k)
+			row.append(float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else math.nan)
+
+		with self.lock:
+			self.pending.append((time.time() if t is None else t, row))
+
+			if time.monotonic() - self.synced >= self.flush_interval:
+				self._flush()
+
+	def _write(self, t, row):
+		"""write a sample into the raw tier and the downsampled tiers"""
+		for tier in self.tiers:
+			if not tier.seconds:
+				tier.write(t, row)
+				continue
+
+			done = tier.add(t, row)
+			if done:
+				tier.write(*done)
+
+	def _flush(self):
+		for t, row in self.pending:
+			self._write(t, row)
+		self.pending.clear()
+
+		self.map.flush()
+		self.synced = time.monotonic()
+
+	def flush(self):
+		with self.lock:
+			self._flush()
+
+	def close(self):
+		"""flush and close, open buckets are written as they are"""
+		with self.lock:
+			self._flush()
+			for tier in self.tiers:
+				if tier.bucket:
+					tier.write(*tier.close_bucket())
+			self.map.flush()
+
+			for tier in self.tiers:
+				tier.release()
+			self.map.close()
+
+	# ----------------------------------------------------------------------------------
+	def tier(self, start):
+		"""finest tier that still holds data from `start`"""
+		for tier in self.tiers:
+			first = tier.first()
+			if first is not None and first <= start:
+				return tier
+		return self.tiers[-1]
+
+	def query(self, start, end=None, fields=None, tier=None):
+		"""rows of [start, end), returns (times, {field: [values]})
+
+		`tier` is a tier name, default the finest tier covering `start`.
+		Samples not yet flushed are included in the raw tier.
+		"""
+		fields = fields or self.fields
+		idx = [self.fields.index(k) for k in fields]
+		end = math.inf if end is None else end
+
+		with self.lock:
+			if tier is None:
+				tier = self.tier(start)
+			else:
+				tier = next(t for t in self.tiers if t.name == tier)
+
+			times = []
+			cols = {k: [] for k in fields}
+
+			for i in range(tier.search(start), tier.meta[1]):
+				j = tier.index(i)
+				t = tier.time(j)
+				if t >= end:
+					break
+
+				times.append(t)
+				for k, n in zip(fields, idx):
+					cols[k].append(tier.value(j, n))
+
+			if not tier.seconds:
+				for t, row in self.pending:
+					if start <= t < end:
+						times.append(t)
+						for k, n in zip(fields, idx):
+							cols[k].append(row[n])
+
+		return times, cols